@@ -0,0 +1,78 @@
+# Compares parsing the whole STEAM_APP_LIST_API response against streaming it and keeping only owned
+# apps, and against streaming it into the SQLite app list cache and reading the owned apps back,
+# for time and peak memory (measured with tracemalloc, so Python allocations only).
+# Usage: python benchmarks/bench_app_list.py [catalog_apps] [owned_apps]
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import humblesteamkeysredeemer as redeemer
+import synthetic
+
+
+def chunks(body):
+    for start in range(0, len(body), redeemer.STEAM_APP_LIST_CHUNK):
+        yield body[start:start + redeemer.STEAM_APP_LIST_CHUNK]
+
+
+def parse_whole(body, owned_app_ids):
+    # What get_owned_apps used to do with response.json()
+    apps = {app["appid"]: app["name"] for app in json.loads(body)["applist"]["apps"]}
+    return {appid: name for appid, name in apps.items() if appid in owned_app_ids}
+
+
+def parse_streamed(body, owned_app_ids):
+    return {appid: name for appid, name in redeemer.iter_app_list(chunks(body)) if appid in owned_app_ids}
+
+
+def parse_into_cache(body, owned_app_ids):
+    # What get_app_list does now
+    with tempfile.TemporaryDirectory() as directory:
+        db = redeemer.open_app_list_cache(os.path.join(directory, "applist.db"))
+        try:
+            redeemer.store_app_list(db, redeemer.iter_app_list(chunks(body)))
+            return redeemer.lookup_app_names(db, owned_app_ids)
+        finally:
+            db.close()
+
+
+def measure(function, body, owned_app_ids):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(body, owned_app_ids)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+def main():
+    app_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    owned_count = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    app_list = synthetic.app_list(app_count)
+    owned_app_ids = set(random.Random(1).sample([app["appid"] for app in app_list["applist"]["apps"]], owned_count))
+    # The response body arrives as bytes, keep it out of the measurements
+    body = json.dumps(app_list).encode("utf-8")
+    del app_list
+
+    whole, whole_time, whole_peak = measure(parse_whole, body, owned_app_ids)
+    streamed, streamed_time, streamed_peak = measure(parse_streamed, body, owned_app_ids)
+    cached, cached_time, cached_peak = measure(parse_into_cache, body, owned_app_ids)
+
+    print(f"{app_count} apps ({len(body) / 2 ** 20:.1f} MB), {owned_count} owned")
+    print(f"whole response: {whole_time:.2f}s, peak {whole_peak / 2 ** 20:.1f} MB")
+    print(f"streamed:       {streamed_time:.2f}s, peak {streamed_peak / 2 ** 20:.1f} MB")
+    print(f"into the cache: {cached_time:.2f}s, peak {cached_peak / 2 ** 20:.1f} MB")
+    print(f"same results: {whole == streamed == cached}")
+    if not whole == streamed == cached:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
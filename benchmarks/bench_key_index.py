@@ -0,0 +1,49 @@
+# Compares the repeated find_dict_keys walks against a single build_key_index pass on a synthetic library.
+# Usage: python benchmarks/bench_key_index.py [orders] [tpks_per_order]
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import humblesteamkeysredeemer as redeemer
+import synthetic
+
+
+def main():
+    order_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    tpks_per_order = int(sys.argv[2]) if len(sys.argv) > 2 else 12
+    order_details = synthetic.order_details(order_count, tpks_per_order)
+    print(f"{order_count} orders, {order_count * tpks_per_order} tpks")
+
+    # What a run used to do: one walk per mode/lookup
+    start = time.perf_counter()
+    walked = {
+        field: list(redeemer.find_dict_keys(order_details, field, True))
+        for field in ("steam_app_id", "key_type_human_name")
+    }
+    chosen = {order["gamekey"]: set(redeemer.find_dict_keys(order["tpkd_dict"], "machine_name")) for order in order_details}
+    walk_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = redeemer.build_key_index(order_details)
+    build_time = time.perf_counter() - start
+    indexed = {field: redeemer.indexed_keys(index, field) for field in ("steam_app_id", "key_type_human_name")}
+    indexed_chosen = {
+        order["gamekey"]: set(tpk["machine_name"] for tpk in index["gamekey"].get(order["gamekey"], []))
+        for order in order_details
+    }
+    index_time = time.perf_counter() - start
+
+    same = all(
+        [redeemer.KeyRecord(tpk).to_dict() for tpk in walked[field]] == [key.to_dict() for key in indexed[field]]
+        for field in walked
+    ) and chosen == indexed_chosen
+    print(f"find_dict_keys walks: {walk_time:.3f}s")
+    print(f"key index:            {index_time:.3f}s (build {build_time:.3f}s), {walk_time / index_time:.1f}x faster")
+    print(f"same results: {same}")
+    if not same:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# Reports peak and steady-state RSS of holding a library's keys as raw tpks inside the full order tree
+# (as before) against slimming orders as they arrive and keeping KeyRecords. Each variant runs in its own process.
+# Usage: python benchmarks/bench_key_records.py [orders] [tpks_per_order]
+import gc
+import json
+import os
+import resource
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import humblesteamkeysredeemer as redeemer
+import synthetic
+
+
+def rss():
+    # (current, peak) in MB
+    status = {}
+    with open("/proc/self/status", "r", encoding="utf-8") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            status[name] = value.strip()
+    if "VmRSS" in status:
+        return int(status["VmRSS"].split()[0]) / 1024, int(status["VmHWM"].split()[0]) / 1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return peak, peak
+
+
+def run_variant(variant, order_count, tpks_per_order):
+    # Orders arrive one response body at a time
+    bodies = [json.dumps(order).encode("utf-8") for order in synthetic.order_details(order_count, tpks_per_order)]
+    gc.collect()
+    # Generating the library takes memory too, compare against what's in use once it's done
+    baseline = rss()[0]
+    try:
+        # Restart the peak from here (Linux)
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+    if variant == "tpks":
+        order_details = [json.loads(body) for body in bodies]
+        keys = [
+            tpk for order in order_details for tpk in order["tpkd_dict"]["all_tpks"] if "steam_app_id" in tpk
+        ]
+    else:
+        order_details = [redeemer.slim_order(json.loads(body)) for body in bodies]
+        key_index = redeemer.build_key_index(order_details)
+        order_details = redeemer.choice_months(order_details)
+        keys = redeemer.indexed_keys(key_index, "steam_app_id")
+    del bodies
+    gc.collect()
+    current, peak = rss()
+    print(json.dumps({"variant": variant, "keys": len(keys), "baseline_mb": baseline, "steady_mb": current, "peak_mb": peak}))
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--variant":
+        run_variant(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+        return
+    order_count = sys.argv[1] if len(sys.argv) > 1 else "2000"
+    tpks_per_order = sys.argv[2] if len(sys.argv) > 2 else "12"
+    print(f"{order_count} orders x {tpks_per_order} tpks")
+    for variant in ("tpks", "records"):
+        result = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--variant", variant, order_count, tpks_per_order],
+            capture_output=True, text=True, check=True,
+        )
+        result = json.loads(result.stdout.strip().splitlines()[-1])
+        print(
+            f"{variant:<8} {result['keys']} keys, steady {result['steady_mb']:.1f} MB, peak {result['peak_mb']:.1f} MB "
+            f"(after generating the library: {result['baseline_mb']:.1f} MB)"
+        )
+
+
+if __name__ == "__main__":
+    main()
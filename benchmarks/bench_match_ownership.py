@@ -0,0 +1,45 @@
+# Compares match_ownership's brute-force scan against the inverted index on synthetic names.
+# Usage: python benchmarks/bench_match_ownership.py [owned_apps] [keys]
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import humblesteamkeysredeemer as redeemer
+import synthetic
+
+
+def main():
+    owned_count = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    key_count = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    rng = random.Random(1)
+
+    owned_app_details = synthetic.owned_app_details(owned_count)
+    owned_names = list(owned_app_details.values())
+    games = [
+        {"human_name": rng.choice(owned_names) if rng.random() < 0.5 else synthetic.random_title(rng)}
+        for _ in range(key_count)
+    ]
+
+    start = time.perf_counter()
+    brute = [redeemer.match_ownership(owned_app_details, game, False) for game in games]
+    brute_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = redeemer.build_ownership_index(owned_app_details)
+    build_time = time.perf_counter() - start
+    indexed = [redeemer.match_ownership(owned_app_details, game, False, index) for game in games]
+    indexed_time = time.perf_counter() - start
+
+    mismatches = sum(1 for a, b in zip(brute, indexed) if a != b)
+    print(f"{owned_count} owned apps, {key_count} keys")
+    print(f"brute force: {brute_time:.2f}s")
+    print(f"indexed:     {indexed_time:.2f}s (index build {build_time:.3f}s), {brute_time / indexed_time:.1f}x faster")
+    print(f"mismatched results: {mismatches}")
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+# Runs the script end to end against the local stand-in and reports how long it took and what it did.
+# Usage: python benchmarks/load_test.py [--mode redeem|redeem-resume|export|export-resume|chooser] [--orders 100 --tpks 8 --latency 0.05 ...]
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import standin as standin_server
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "humblesteamkeysredeemer.py")
+
+# Answers to the script's prompts, in the order it asks them
+ANSWERS = {
+    # Auto-Redeem, reveal unrevealed keys, retry revealed ones too, don't filter live, accept skipped.txt
+    "redeem": ["1", "y", "y", "n", ""],
+    # Auto-Redeem after one that stopped with keys revealed ahead: reveal unrevealed keys but don't retry revealed ones
+    "redeem-resume": ["1", "y", "n", "n", ""],
+    # Export, Steam only, revealed, unrevealed, reveal all, confirm, check ownership, CSV
+    "export": ["2", "y", "y", "y", "y", "y", "y", "csv"],
+    # Export picking up after an interrupted one: Steam only, unrevealed only, reveal all, confirm, no ownership, CSV
+    "export-resume": ["2", "y", "n", "y", "y", "y", "n", "csv"],
+    # Humble Chooser, auto-redeem after, two games from the first month, one from the second, skip the third,
+    # don't filter live, accept skipped.txt
+    "chooser": ["3", "y", "1,2", "y", "3", "y", "", "n", ""],
+}
+
+
+def ledger_results(workdir):
+    if not os.path.exists(os.path.join(workdir, "redemptions.db")):
+        return {}
+    db = sqlite3.connect(os.path.join(workdir, "redemptions.db"))
+    try:
+        return {str(code): count for code, count in db.execute("SELECT code, COUNT(*) FROM keys GROUP BY code")}
+    finally:
+        db.close()
+
+
+def interrupt_export(standin, workdir):
+    # Reveals half the unrevealed Steam keys and checkpoints them, as if an export had been stopped
+    # halfway. Returns how many rows the resumed export should have.
+    unrevealed = [
+        tpk for order in standin.orders.values() for tpk in order["tpkd_dict"]["all_tpks"]
+        if "steam_app_id" in tpk and "redeemed_key_val" not in tpk
+    ]
+    with open(os.path.join(workdir, ".revealcheckpoint"), "w", encoding="utf-8") as checkpoint:
+        for tpk in unrevealed[:len(unrevealed) // 2]:
+            form = {"key": tpk["gamekey"], "keyindex": str(tpk["keyindex"]), "keytype": tpk["machine_name"]}
+            key = standin.reveal(form)["key"]
+            checkpoint.write(json.dumps({"gamekey": tpk["gamekey"], "keyindex": tpk["keyindex"], "redeemed_key_val": key}) + "\n")
+    return len(unrevealed)
+
+
+def interrupt_redeem(standin, workdir, count=5):
+    # Reveals a few unowned Steam keys and records them as revealed ahead, as if Auto-Redeem had
+    # been stopped before Steam got to them. Returns the keys, which the next run has to redeem.
+    unrevealed = [
+        tpk for order in standin.orders.values() for tpk in order["tpkd_dict"]["all_tpks"]
+        if tpk.get("steam_app_id") is not None and tpk["steam_app_id"] not in standin.owned and "redeemed_key_val" not in tpk
+    ]
+    keys = []
+    with open(os.path.join(workdir, ".revealedahead"), "w", encoding="utf-8") as record:
+        for tpk in unrevealed[:count]:
+            form = {"key": tpk["gamekey"], "keyindex": str(tpk["keyindex"]), "keytype": tpk["machine_name"]}
+            key = standin.reveal(form)["key"]
+            record.write(json.dumps({"gamekey": tpk["gamekey"], "keyindex": tpk["keyindex"], "redeemed_key_val": key}) + "\n")
+            keys.append(key)
+    return keys
+
+
+def exported_rows(workdir):
+    for filename in os.listdir(workdir):
+        if filename.startswith("humble_export_") and filename.endswith(".csv"):
+            with open(os.path.join(workdir, filename), "r", encoding="utf-8") as f:
+                return sum(1 for line in csv.reader(f)) - 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the script against the local stand-in")
+    standin_server.add_standin_arguments(parser)
+    parser.add_argument("--mode", choices=sorted(ANSWERS), default="redeem")
+    parser.add_argument("--timeout", type=float, default=60 * 60, help="seconds before giving up on the run")
+    parser.set_defaults(steam_window=60)
+    args = parser.parse_args()
+
+    standin = standin_server.standin_from_arguments(args)
+    server, base_url = standin_server.start(standin)
+    with tempfile.TemporaryDirectory() as workdir:
+        standin_server.write_cookies(workdir)
+        # HOME keeps the run's rate limit history away from the real one
+        env = dict(os.environ, HOME=workdir, TERM=os.environ.get("TERM", "dumb"))
+        env.update(standin_server.environment(base_url, standin))
+
+        expected_rows = interrupt_export(standin, workdir) if args.mode == "export-resume" else None
+        revealed_ahead = interrupt_redeem(standin, workdir) if args.mode == "redeem-resume" else None
+        print(f"{args.mode}: {len(standin.orders)} orders, {len(standin.keys)} keys on {base_url}")
+        start = time.perf_counter()
+        with open(os.path.join(workdir, "output.txt"), "w", encoding="utf-8") as output:
+            run = subprocess.run(
+                [sys.executable, os.path.abspath(SCRIPT)],
+                input="\n".join(ANSWERS[args.mode]) + "\n",
+                stdout=output,
+                cwd=workdir,
+                env=env,
+                text=True,
+                timeout=args.timeout,
+            )
+        seconds = time.perf_counter() - start
+        server.shutdown()
+
+        report = dict(standin.summary(), mode=args.mode, seconds=round(seconds, 3), exit_code=run.returncode)
+        report["ledger"] = ledger_results(workdir)
+        if expected_rows is not None:
+            report["exported_rows"] = exported_rows(workdir)
+            report["expected_rows"] = expected_rows
+        if revealed_ahead is not None:
+            report["revealed_ahead_redeemed"] = len(standin.activated.intersection(revealed_ahead))
+            report["revealed_ahead"] = len(revealed_ahead)
+        if args.mode == "chooser":
+            report["chosen_registered"] = len(standin.registered.intersection(standin.chosen))
+            report["chosen"] = len(standin.chosen)
+        if os.path.exists(os.path.join(workdir, "metrics.json")):
+            # The script's own view of the run
+            with open(os.path.join(workdir, "metrics.json"), "r", encoding="utf-8") as f:
+                report["metrics"] = json.load(f)
+        print(json.dumps(report, indent=2))
+        if run.returncode != 0:
+            with open(os.path.join(workdir, "error.log"), "r", encoding="utf-8") as f:
+                print(f.read()[-2000:])
+            sys.exit(run.returncode)
+        if expected_rows is not None and report["exported_rows"] != expected_rows:
+            print(f"The resumed export has {report['exported_rows']} rows, expected {expected_rows}")
+            sys.exit(1)
+        if revealed_ahead and not report["revealed_ahead_redeemed"]:
+            print("None of the keys revealed ahead by the stopped run were redeemed")
+            sys.exit(1)
+        if args.mode == "chooser" and not 0 < report["chosen_registered"] == report["chosen"]:
+            print(f"{report['chosen_registered']} of the {report['chosen']} chosen games' keys reached Steam")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
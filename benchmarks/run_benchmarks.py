@@ -0,0 +1,219 @@
+# Times the stages that scale with library size on synthetic data and saves the results as JSON.
+# Usage: python benchmarks/run_benchmarks.py [--scales small,medium,large] [--output bench_results.json]
+#        python benchmarks/run_benchmarks.py --compare old.json new.json
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+import humblesteamkeysredeemer as redeemer
+import synthetic
+
+# orders, tpks per order, Steam catalog size, owned apps
+SCALES = {
+    "small": (50, 6, 20000, 300),
+    "medium": (300, 10, 80000, 1500),
+    "large": (1000, 12, 160000, 5000),
+}
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        # Steam responses are parsed on every call
+        return json.loads(self.data)
+
+    def iter_content(self, chunk_size):
+        data = self.data.encode("utf-8")
+        for start in range(0, len(data), chunk_size):
+            yield data[start:start + chunk_size]
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeSteamSession:
+    def __init__(self, app_list, userdata, packages):
+        self.responses = {
+            redeemer.STEAM_APP_LIST_API: json.dumps(app_list),
+            redeemer.STEAM_USERDATA_API: json.dumps(userdata),
+        }
+        self.packages = packages
+
+    def get(self, url, params=None, **kwargs):
+        if url == redeemer.STEAM_PACKAGE_DETAILS_API:
+            package_id = params["packageids"]
+            apps = [{"id": appid, "name": name} for appid, name in self.packages[package_id]]
+            return FakeResponse(json.dumps({str(package_id): {"success": True, "data": {"apps": apps}}}))
+        return FakeResponse(self.responses[url])
+
+
+def timed(results, stage, scale, function, *args):
+    start = time.perf_counter()
+    value = function(*args)
+    seconds = time.perf_counter() - start
+    results.append({"stage": stage, "scale": scale, "seconds": round(seconds, 6)})
+    print(f"  {stage:<28} {seconds:8.3f}s")
+    return value
+
+
+def find_steam_keys(order_details):
+    # Equivalent of the walks __main__ and the modes used to do on every run
+    return [
+        tpk for tpk in redeemer.find_dict_keys(order_details, "steam_app_id", True)
+        if tpk.get("key_type_human_name") == "Steam"
+    ]
+
+
+def indexed_steam_keys(order_details):
+    index = redeemer.build_key_index(order_details)
+    return [tpk for tpk in redeemer.indexed_keys(index, "steam_app_id") if tpk.get("key_type_human_name") == "Steam"]
+
+
+def match_all(owned_app_details, games):
+    index = redeemer.build_ownership_index(owned_app_details)
+    return [redeemer.match_ownership(owned_app_details, game, False, index) for game in games]
+
+
+def owned_apps_cold(steam_session):
+    for cache_file in (redeemer.STEAM_APP_LIST_CACHE, redeemer.STEAM_PACKAGE_CACHE):
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+    return redeemer.get_owned_apps(steam_session)
+
+
+def previous_run_filter(steam_keys):
+    previous = redeemer.previous_key_values()
+    return [key for key in steam_keys if key.get("redeemed_key_val") not in previous]
+
+
+def original_order_sort(steam_keys, subset):
+    # As redeem_steam_keys restores Humble's order after prompt_skipped
+    attempted = {(key["gamekey"], key["keyindex"]) for key in subset}
+    return [key for key in steam_keys if (key["gamekey"], key["keyindex"]) in attempted]
+
+
+def run_scale(scale, results):
+    order_count, tpks_per_order, catalog_size, owned_count = SCALES[scale]
+    print(f"{scale}: {order_count} orders x {tpks_per_order} tpks, {catalog_size} Steam apps, {owned_count} owned")
+
+    app_list = synthetic.app_list(catalog_size)
+    userdata = synthetic.userdata(app_list, owned_count)
+    steam_session = FakeSteamSession(app_list, userdata, synthetic.packages(app_list, userdata))
+    owned_ids = set(userdata["rgOwnedApps"])
+    owned_apps = [app for app in app_list["applist"]["apps"] if app["appid"] in owned_ids]
+    order_details = synthetic.order_details(
+        order_count, tpks_per_order, owned_apps, [app["name"] for app in owned_apps]
+    )
+
+    steam_keys = timed(results, "find_dict_keys", scale, find_steam_keys, order_details)
+    timed(results, "build_key_index", scale, indexed_steam_keys, order_details)
+    timed(results, "dedupe_keys", scale, redeemer.dedupe_keys, steam_keys)
+
+    timed(results, "get_owned_apps (cold)", scale, owned_apps_cold, steam_session)
+    owned_app_details = timed(results, "get_owned_apps (cached)", scale, redeemer.get_owned_apps, steam_session)
+
+    games = [key for key in steam_keys if key["steam_app_id"] not in owned_app_details]
+    timed(results, "match_ownership", scale, match_all, owned_app_details, games)
+
+    # A ledger with half of the revealed keys already in it
+    revealed = [key for key in steam_keys if "redeemed_key_val" in key]
+    redeemer.write_keys(1, revealed[::2])
+    timed(results, "previous run filter", scale, previous_run_filter, steam_keys)
+
+    rng = random.Random(1)
+    subset = rng.sample(steam_keys, len(steam_keys) // 2)
+    timed(results, "original order sort", scale, original_order_sort, steam_keys, subset)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(scales, output):
+    results = []
+    output = os.path.abspath(output)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        # Caches and the ledger are written to the working directory
+        os.chdir(workdir)
+        try:
+            for scale in scales:
+                redeemer.ledger = redeemer.open_ledger()
+                run_scale(scale, results)
+                redeemer.ledger.close()
+                redeemer.ledger = None
+                os.remove(redeemer.LEDGER_DB)
+        finally:
+            os.chdir(cwd)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scales": {scale: SCALES[scale] for scale in scales},
+        "results": results,
+    }
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+
+def compare(old_file, new_file):
+    reports = []
+    for filename in (old_file, new_file):
+        with open(filename, "r", encoding="utf-8") as f:
+            reports.append(json.load(f))
+    old, new = reports
+    print(f"{old.get('commit')} ({old['timestamp']}) -> {new.get('commit')} ({new['timestamp']})")
+    old_results = {(r["stage"], r["scale"]): r["seconds"] for r in old["results"]}
+    for result in new["results"]:
+        before = old_results.get((result["stage"], result["scale"]))
+        after = result["seconds"]
+        if before is None:
+            change = "new"
+        elif before == after or before == 0 or after == 0:
+            change = ""
+        else:
+            change = f"{before / after:.2f}x faster" if after <= before else f"{after / before:.2f}x slower"
+        before = "-" if before is None else f"{before:.3f}s"
+        print(f"{result['scale']:<8} {result['stage']:<28} {before:>10} {after:9.3f}s  {change}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the redeemer on synthetic libraries")
+    parser.add_argument("--scales", default="small,medium,large", help="comma separated, from: " + ", ".join(SCALES))
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two saved result files")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    scales = [scale.strip() for scale in args.scales.split(",") if scale.strip()]
+    unknown = [scale for scale in scales if scale not in SCALES]
+    if unknown:
+        parser.error("unknown scale: " + ", ".join(unknown))
+    run(scales, args.output)
+
+
+if __name__ == "__main__":
+    main()
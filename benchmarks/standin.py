@@ -0,0 +1,378 @@
+# Local stand-in for the Humble and Steam endpoints the script uses, serving a recorded or synthetic
+# library with optional latency, Steam's error 53 throttling and Steam error pages.
+# Usage: python benchmarks/standin.py [--fixture fixture.json | --orders 200 --tpks 10 ...] [--latency 0.05]
+#        python benchmarks/standin.py --record fixture.json [--userdata userdata.json]
+# The script talks to it when started with the environment variables this prints.
+import argparse
+import collections
+import hashlib
+import json
+import os
+import pickle
+import random
+import sqlite3
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic
+
+KEY_CHARACTERS = "ABCDEFGHJKLMNPQRSTVWXYZ0123456789"
+
+
+def revealed_key(gamekey, keyindex):
+    digest = hashlib.sha256(f"{gamekey}/{keyindex}".encode("utf-8")).digest()
+    characters = "".join(KEY_CHARACTERS[byte % len(KEY_CHARACTERS)] for byte in digest[:15])
+    return "-".join(characters[i:i + 5] for i in range(0, 15, 5))
+
+
+class StandIn:
+    # Server side state: the library, what the Steam account owns, and Steam's activation budget
+    def __init__(self, fixture, latency=0, jitter=0, success_limit=50, failure_limit=10, window=60 * 60, steam_errors=0):
+        self.orders = collections.OrderedDict((order["gamekey"], order) for order in fixture["orders"])
+        self.choices = fixture.get("choices", {})
+        self.app_list = json.dumps(fixture["app_list"]).encode("utf-8")
+        self.userdata = fixture["userdata"]
+        self.owned = set(self.userdata["rgOwnedApps"])
+        self.packages = {int(package_id): apps for package_id, apps in fixture.get("packages", {}).items()}
+        self.latency = latency
+        self.jitter = jitter
+        self.success_limit = success_limit
+        self.failure_limit = failure_limit
+        self.window = window
+        self.steam_errors = steam_errors
+        self.successes = collections.deque()
+        self.failures = collections.deque()
+        self.activated = set()
+        # Keys Steam has been asked about, and keys Humble handed out for Choice games picked during the run
+        self.registered = set()
+        self.chosen = []
+        self.lock = threading.Lock()
+        self.requests = collections.Counter()
+        self.steam_results = collections.Counter()
+        # Every key that exists in the library, revealed or not, so Steam can recognise them
+        self.keys = {}
+        for order in self.orders.values():
+            for keyindex, tpk in enumerate(order["tpkd_dict"]["all_tpks"]):
+                tpk.setdefault("keyindex", keyindex)
+                self.keys[tpk.get("redeemed_key_val") or revealed_key(tpk["gamekey"], tpk["keyindex"])] = tpk
+
+    def delay(self):
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+
+    def order_list(self):
+        return [{"gamekey": gamekey} for gamekey in self.orders]
+
+    def order(self, gamekey):
+        with self.lock:
+            order = self.orders.get(gamekey)
+            return None if order is None else json.loads(json.dumps(order))
+
+    def reveal(self, form):
+        with self.lock:
+            order = self.orders.get(form.get("key"))
+            tpks = order["tpkd_dict"]["all_tpks"] if order else []
+            for tpk in tpks:
+                if str(tpk["keyindex"]) == form.get("keyindex") and tpk["machine_name"] == form.get("keytype"):
+                    if "redeemed_key_val" not in tpk:
+                        tpk["redeemed_key_val"] = revealed_key(tpk["gamekey"], tpk["keyindex"])
+                    return {"success": True, "key": tpk["redeemed_key_val"]}
+        return {"success": False, "error_msg": "Key not found"}
+
+    def choice_page(self, choice_url):
+        options = self.choices.get(choice_url)
+        if options is None:
+            return None
+        data = json.dumps({"contentChoiceOptions": options})
+        return (
+            '<html><body><script id="webpack-monthly-product-data" type="application/json">'
+            f"{data}</script></body></html>"
+        )
+
+    def choose(self, form, identifiers):
+        # All of the chosen identifiers or none of them, like Humble's choice modal
+        with self.lock:
+            order = self.orders.get(form.get("gamekey"))
+            if order is None or "choice_url" not in order["product"]:
+                return {"success": False, "errors": {"gamekey": ["Unknown order"]}}
+            if order.get("choices_remaining", 0) < max(1, len(identifiers)):
+                return {"success": False, "errors": {"dummy": ["No choices remaining"]}}
+            options = self.choices[order["product"]["choice_url"]]["contentChoiceData"]
+            content_choices = options.get(form.get("parent_identifier"), {}).get("content_choices", {})
+            if not identifiers or any(identifier not in content_choices for identifier in identifiers):
+                return {"success": False, "errors": {"dummy": ["Unknown choice"]}}
+            tpks = order["tpkd_dict"]["all_tpks"]
+            for identifier in identifiers:
+                for template in content_choices[identifier].get("tpkds", []):
+                    tpk = dict(template, keyindex=len(tpks))
+                    tpks.append(tpk)
+                    self.keys[revealed_key(tpk["gamekey"], tpk["keyindex"])] = tpk
+                    self.chosen.append(revealed_key(tpk["gamekey"], tpk["keyindex"]))
+            order["choices_remaining"] -= len(identifiers)
+        return {"success": True}
+
+    def userdata_response(self):
+        with self.lock:
+            return dict(self.userdata, rgOwnedApps=sorted(self.owned))
+
+    def package_details(self, package_id):
+        apps = self.packages.get(int(package_id)) if package_id.isdigit() else None
+        if apps is None:
+            return {package_id: {"success": False}}
+        return {package_id: {"success": True, "data": {"apps": [{"id": appid, "name": name} for appid, name in apps]}}}
+
+    def register_key(self, product_key):
+        # Same budgets as Steam: successes and failures per window, answered with 53 once either runs out
+        with self.lock:
+            now = time.time()
+            self.registered.add(product_key)
+            for attempts in (self.successes, self.failures):
+                while attempts and attempts[0] <= now - self.window:
+                    attempts.popleft()
+            if len(self.successes) >= self.success_limit or len(self.failures) >= self.failure_limit:
+                code = 53
+            else:
+                tpk = self.keys.get(product_key)
+                if tpk is None:
+                    code = 14
+                elif tpk.get("steam_app_id") in self.owned:
+                    code = 9
+                elif product_key in self.activated:
+                    code = 15
+                else:
+                    code = 0
+                    self.activated.add(product_key)
+                    if tpk.get("steam_app_id") is not None:
+                        self.owned.add(tpk["steam_app_id"])
+                if code == 0:
+                    self.successes.append(now)
+                else:
+                    self.failures.append(now)
+            self.steam_results[code] += 1
+        if code == 0:
+            return {"success": 1, "purchase_receipt_info": {"line_items": [{"line_item_description": tpk["human_name"]}]}}
+        return {"success": 2, "purchase_result_details": code}
+
+    def summary(self):
+        with self.lock:
+            return {"requests": dict(self.requests), "steam_results": dict(self.steam_results)}
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type="application/json"):
+        if not isinstance(body, bytes):
+            body = (json.dumps(body) if content_type == "application/json" else body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def endpoint(self, path):
+        for prefix in ("/api/v1/order/", "/subscription/"):
+            if path.startswith(prefix):
+                return prefix
+        return path
+
+    def do_GET(self):
+        standin = self.server.standin
+        path, query = urlsplit(self.path)[2:4]
+        with standin.lock:
+            standin.requests["GET " + self.endpoint(path)] += 1
+        standin.delay()
+        if path in ("/home/library", "/account/registerkey"):
+            # Saved sessions are always still signed in
+            self.send_body(200, "<html></html>", "text/html")
+        elif path == "/api/v1/user/order":
+            self.send_body(200, standin.order_list())
+        elif path.startswith("/api/v1/order/"):
+            order = standin.order(unquote(path[len("/api/v1/order/"):]))
+            self.send_body(404, {"error": "Not found"}) if order is None else self.send_body(200, order)
+        elif path.startswith("/subscription/"):
+            page = standin.choice_page(unquote(path[len("/subscription/"):]))
+            self.send_body(404, "Not found", "text/html") if page is None else self.send_body(200, page, "text/html")
+        elif path == "/dynamicstore/userdata/":
+            self.send_body(200, standin.userdata_response())
+        elif path == "/ISteamApps/GetAppList/v2/":
+            self.send_body(200, standin.app_list)
+        elif path == "/api/packagedetails/":
+            self.send_body(200, standin.package_details(parse_qs(query).get("packageids", [""])[0]))
+        else:
+            self.send_body(404, {"error": "Not found"})
+
+    def do_POST(self):
+        standin = self.server.standin
+        path = urlsplit(self.path).path
+        length = int(self.headers.get("Content-Length", 0))
+        fields = parse_qs(self.rfile.read(length).decode("utf-8"))
+        form = {name: values[0] for name, values in fields.items()}
+        with standin.lock:
+            standin.requests["POST " + path] += 1
+        standin.delay()
+        if path == "/humbler/redeemkey":
+            self.send_body(200, standin.reveal(form))
+        elif path == "/humbler/choosecontent":
+            self.send_body(200, standin.choose(form, fields.get("chosen_identifiers[]", [])))
+        elif path == "/account/ajaxregisterkey/":
+            if random.random() < standin.steam_errors:
+                # An overloaded Steam answers with an error page and never sees the key
+                self.send_body(502, "<html>Bad Gateway</html>", "text/html")
+            else:
+                self.send_body(200, standin.register_key(form.get("product_key", "")))
+        else:
+            self.send_body(404, {"error": "Not found"})
+
+
+def synthetic_fixture(order_count, tpks_per_order, app_count, owned_count, month_count=0, seed=1):
+    app_list = synthetic.app_list(app_count, seed)
+    userdata = synthetic.userdata(app_list, owned_count, seed=seed)
+    owned = set(userdata["rgOwnedApps"])
+    owned_apps = [app for app in app_list["applist"]["apps"] if app["appid"] in owned]
+    orders = synthetic.order_details(
+        order_count, tpks_per_order, app_list["applist"]["apps"][:owned_count * 4], [app["name"] for app in owned_apps], seed
+    )
+    rng = random.Random(seed)
+    choices = {}
+    # Choice games the account doesn't have yet, so the ones picked go on to Steam
+    unowned_apps = [app for app in app_list["applist"]["apps"] if app["appid"] not in owned]
+    for number in range(month_count):
+        order, options = synthetic.choice_month(rng, number, 12, 4, unowned_apps)
+        orders.append(order)
+        choices[order["product"]["choice_url"]] = options
+    packages = synthetic.packages(app_list, userdata, seed)
+    return {"orders": orders, "choices": choices, "app_list": app_list, "userdata": userdata, "packages": packages}
+
+
+def record_fixture(fixture_file, userdata_file=None, directory="."):
+    # Builds a fixture from the caches a real run leaves behind, and optionally a saved userdata response
+    with open(os.path.join(directory, ".humbleorders"), "r", encoding="utf-8") as f:
+        orders = [entry["details"] for entry in json.load(f).values()]
+    choices = {}
+    if os.path.exists(os.path.join(directory, ".humblechoices")):
+        with open(os.path.join(directory, ".humblechoices"), "r", encoding="utf-8") as f:
+            choices = {choice_url: entry["data"] for choice_url, entry in json.load(f).items()}
+    apps = []
+    if os.path.exists(os.path.join(directory, ".steamapplist.db")):
+        db = sqlite3.connect(os.path.join(directory, ".steamapplist.db"))
+        try:
+            apps = [{"appid": appid, "name": name} for appid, name in db.execute("SELECT appid, name FROM apps")]
+        finally:
+            db.close()
+    packages = {}
+    if os.path.exists(os.path.join(directory, ".steampackages")):
+        with open(os.path.join(directory, ".steampackages"), "r", encoding="utf-8") as f:
+            packages = json.load(f)
+    userdata = {"rgOwnedApps": [], "rgOwnedPackages": [], "rgWishlist": [], "rgIgnoredApps": {}}
+    if userdata_file:
+        with open(userdata_file, "r", encoding="utf-8") as f:
+            userdata = json.load(f)
+    fixture = {
+        "orders": orders,
+        "choices": choices,
+        "app_list": {"applist": {"apps": apps}},
+        "userdata": userdata,
+        "packages": packages,
+    }
+    with open(fixture_file, "w", encoding="utf-8") as f:
+        json.dump(fixture, f)
+    print(f"Recorded {len(orders)} orders, {len(choices)} Choice months and {len(apps)} Steam apps to {fixture_file}")
+
+
+def write_cookies(directory="."):
+    # Saved sessions for the stand-in, so the script never opens a browser or asks for a password
+    with open(os.path.join(directory, ".humblecookies"), "wb") as f:
+        pickle.dump([{"name": "csrf_cookie", "value": "standin", "domain": "127.0.0.1", "path": "/"}], f)
+    jar = requests.cookies.RequestsCookieJar()
+    jar.set("sessionid", "standin", domain="127.0.0.1", path="/")
+    with open(os.path.join(directory, ".steamcookies"), "wb") as f:
+        pickle.dump(jar, f)
+
+
+def environment(base_url, standin=None):
+    env = {"HUMBLE_BASE_URL": base_url, "STEAM_STORE_BASE_URL": base_url, "STEAM_API_BASE_URL": base_url}
+    if standin is not None:
+        # Keep the script's rate limiter in step with the emulated throttling
+        env.update({
+            "STEAM_SUCCESS_LIMIT": str(standin.success_limit),
+            "STEAM_FAILURE_LIMIT": str(standin.failure_limit),
+            "STEAM_RATE_WINDOW": str(standin.window),
+        })
+    return env
+
+
+def start(standin, port=0):
+    # Serves on a background thread, returns the server and its base URL
+    server = ThreadingHTTPServer(("127.0.0.1", port), StandInHandler)
+    server.daemon_threads = True
+    server.standin = standin
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def add_standin_arguments(parser):
+    parser.add_argument("--fixture", help="recorded library to serve instead of a synthetic one")
+    parser.add_argument("--orders", type=int, default=100)
+    parser.add_argument("--tpks", type=int, default=8, help="keys per order")
+    parser.add_argument("--months", type=int, default=3, help="Humble Choice months with choices left")
+    parser.add_argument("--apps", type=int, default=50000, help="Steam catalog size")
+    parser.add_argument("--owned", type=int, default=1000, help="apps the Steam account owns")
+    parser.add_argument("--latency", type=float, default=0, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0, help="up to this many more seconds at random")
+    parser.add_argument("--steam-success-limit", type=int, default=50)
+    parser.add_argument("--steam-failure-limit", type=int, default=10)
+    parser.add_argument("--steam-window", type=float, default=60 * 60, help="seconds")
+    parser.add_argument("--steam-errors", type=float, default=0, help="share of key activations answered with a 502")
+
+
+def standin_from_arguments(args):
+    if args.fixture:
+        with open(args.fixture, "r", encoding="utf-8") as f:
+            fixture = json.load(f)
+    else:
+        fixture = synthetic_fixture(args.orders, args.tpks, args.apps, args.owned, args.months)
+    return StandIn(
+        fixture, args.latency, args.jitter, args.steam_success_limit, args.steam_failure_limit, args.steam_window,
+        args.steam_errors,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a stand-in for the Humble and Steam endpoints")
+    add_standin_arguments(parser)
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--cookies", action="store_true", help="write saved sessions for the stand-in to this folder")
+    parser.add_argument("--record", metavar="FIXTURE", help="save this folder's caches as a fixture and exit")
+    parser.add_argument("--userdata", help="saved userdata response to include when recording")
+    args = parser.parse_args()
+
+    if args.record:
+        record_fixture(args.record, args.userdata)
+        return
+    standin = standin_from_arguments(args)
+    server, base_url = start(standin, args.port)
+    if args.cookies:
+        write_cookies()
+    print(f"Serving {len(standin.orders)} orders and {len(standin.keys)} keys on {base_url}, set:")
+    for name, value in environment(base_url, standin).items():
+        print(f"  {name}={value}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(json.dumps(standin.summary(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
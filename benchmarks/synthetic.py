@@ -0,0 +1,160 @@
+# Generators for synthetic Humble and Steam data of realistic shape and size, for the benchmarks.
+import random
+
+WORDS = [
+    "the", "of", "and", "a", "dark", "souls", "legend", "quest", "space", "war", "hunter", "city",
+    "empire", "tales", "shadow", "dragon", "age", "hero", "night", "lost", "world", "star", "rise",
+    "fall", "kingdom", "battle", "farm", "simulator", "tycoon", "racing", "zombie", "island", "rogue",
+    "dungeon", "knight", "pixel", "super", "mega", "galaxy", "ocean", "forest", "iron", "blood",
+    "edition", "deluxe", "remastered", "definitive", "goty", "ii", "iii", "2", "3", "4", "dlc",
+    "soundtrack", "pack", "bundle", "tactics", "chronicles", "origins", "legacy", "frontier",
+]
+
+
+def random_word(rng):
+    if rng.random() < 0.3:
+        return rng.choice(WORDS)
+    # Real catalogs have a much wider vocabulary than the common words above
+    return "".join(rng.choice("bcdfghklmnprstvz") + rng.choice("aeiou") for _ in range(rng.randint(2, 4)))
+
+
+def random_title(rng):
+    title = " ".join(random_word(rng) for _ in range(rng.randint(1, 5))).title()
+    if rng.random() < 0.1:
+        # Some names lose their spacing or gain punctuation between stores
+        title = title.replace(" ", rng.choice(["", ": ", " - "]), 1)
+    return title
+
+
+def app_list(app_count, seed=1):
+    # STEAM_APP_LIST_API response
+    rng = random.Random(seed)
+    appids = rng.sample(range(10, app_count * 20), app_count)
+    return {"applist": {"apps": [{"appid": appid, "name": random_title(rng)} for appid in appids]}}
+
+
+def userdata(apps, owned_count, package_count=None, seed=1):
+    # STEAM_USERDATA_API response owning owned_count apps out of an app_list() response
+    rng = random.Random(seed)
+    owned = rng.sample([app["appid"] for app in apps["applist"]["apps"]], owned_count)
+    package_count = owned_count // 2 if package_count is None else package_count
+    return {
+        "rgOwnedApps": owned,
+        "rgOwnedPackages": rng.sample(range(1, package_count * 50), package_count),
+        "rgWishlist": [],
+        "rgIgnoredApps": {},
+    }
+
+
+def packages(apps, userdata, seed=1):
+    # STEAM_PACKAGE_DETAILS_API "data" for each package in userdata, as {package_id: [[appid, name], ...]}
+    rng = random.Random(seed)
+    names = {app["appid"]: app["name"] for app in apps["applist"]["apps"]}
+    owned = userdata["rgOwnedApps"]
+    return {
+        package_id: [[appid, names[appid]] for appid in rng.sample(owned, min(len(owned), rng.randint(1, 3)))]
+        for package_id in userdata["rgOwnedPackages"]
+    }
+
+
+def order(rng, number, tpk_count, apps=None, owned_names=None):
+    gamekey = f"gamekey{number:06d}"
+    tpks = []
+    for keyindex in range(tpk_count):
+        if apps and rng.random() < 0.3:
+            # Titles Humble shares with the Steam catalog, so ownership matching has real work to do
+            app = rng.choice(apps)
+            steam_app_id, human_name = app["appid"], app["name"]
+        else:
+            steam_app_id = rng.randint(10, 2000000)
+            human_name = rng.choice(owned_names) if owned_names and rng.random() < 0.2 else random_title(rng)
+        tpk = {
+            "machine_name": f"game{number}_{keyindex}_steam",
+            "gamekey": gamekey,
+            "keyindex": keyindex,
+            "human_name": human_name,
+            "key_type": "steam",
+            "key_type_human_name": "Steam",
+            "steam_app_id": steam_app_id if rng.random() < 0.9 else None,
+            "is_gift": False,
+            "is_expired": False,
+            "instructions_html": "<p>" + "Redeem on Steam. " * 10 + "</p>",
+        }
+        if rng.random() < 0.6:
+            tpk["redeemed_key_val"] = "-".join(
+                "".join(rng.choice("ABCDEFGHJKLMNPQRSTVWXYZ0123456789") for _ in range(5)) for _ in range(3)
+            )
+        if rng.random() < 0.1:
+            tpk["key_type"] = "generic"
+            tpk["key_type_human_name"] = "Other Key"
+            del tpk["steam_app_id"]
+        tpks.append(tpk)
+    # Raw orders carry a lot more than keys
+    subproducts = [
+        {
+            "machine_name": f"game{number}_{i}",
+            "human_name": f"Game {number} {i}",
+            "icon": "https://example.com/icon.png",
+            "downloads": [{"platform": "windows", "download_struct": [{"sha1": "0" * 40, "file_size": 1234}]}],
+            "payee": {"human_name": "Publisher", "machine_name": "publisher"},
+        }
+        for i in range(tpk_count)
+    ]
+    return {
+        "gamekey": gamekey,
+        "created": "2020-01-01T00:00:00",
+        "product": {"machine_name": f"bundle{number}", "human_name": f"Bundle {number}", "category": "bundle"},
+        "subproducts": subproducts,
+        "tpkd_dict": {"all_tpks": tpks},
+    }
+
+
+def order_details(order_count, tpks_per_order, apps=None, owned_names=None, seed=1):
+    # Result of get_humble_orders() for a library of order_count orders
+    rng = random.Random(seed)
+    return [order(rng, number, tpks_per_order, apps, owned_names) for number in range(order_count)]
+
+
+def owned_app_details(owned_count, seed=1):
+    # get_owned_apps() result
+    rng = random.Random(seed)
+    return {appid: random_title(rng) for appid in range(10, 10 + owned_count * 10, 10)}
+
+
+def choice_month(rng, number, game_count, choices, apps=None):
+    # A Humble Choice order with nothing chosen yet, and the contentChoiceOptions its page serves
+    gamekey = f"choice{number:06d}"
+    choice_url = f"month-{number}"
+    content_choices = {}
+    for i in range(game_count):
+        machine_name = f"choice{number}_{i}"
+        app = rng.choice(apps) if apps and rng.random() < 0.3 else None
+        title = app["name"] if app else random_title(rng)
+        content_choices[machine_name] = {
+            "title": title,
+            "display_item_machine_name": machine_name,
+            "user_rating": {"review_text": "Very_Positive", "steam_percent|decimal": 0.9},
+            "tpkds": [{
+                "machine_name": f"{machine_name}_steam",
+                "gamekey": gamekey,
+                "human_name": title,
+                "key_type": "steam",
+                "key_type_human_name": "Steam",
+                "steam_app_id": app["appid"] if app else rng.randint(10, 2000000),
+                "is_gift": False,
+                "is_expired": False,
+            }],
+        }
+    order = {
+        "gamekey": gamekey,
+        "created": f"2020-{number % 12 + 1:02d}-01T00:00:00",
+        "choices_remaining": choices,
+        "product": {"machine_name": choice_url, "human_name": f"Humble Choice {number}", "choice_url": choice_url},
+        "tpkd_dict": {"all_tpks": []},
+    }
+    options = {
+        "usesChoices": True,
+        "canRedeemGames": True,
+        "contentChoiceData": {"initial": {"content_choices": content_choices}},
+    }
+    return order, options
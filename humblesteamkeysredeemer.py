@@ -1,7 +1,9 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError
 from selenium import webdriver
 from selenium.common.exceptions import WebDriverException
-from fuzzywuzzy import fuzz
+from fuzzywuzzy import fuzz, utils
 import steam.webauth as wa
 import time
 import pickle
@@ -14,7 +16,18 @@ import os
 from base64 import b64encode
 import atexit
 import signal
+import random
+import queue
+import threading
+import sqlite3
+import csv
+import codecs
+import re
+import functools
+import collections
+from contextlib import contextmanager
 from http.client import responses
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 
 #patch steam webauth for password feedback
 wa.getpass = pwinput
@@ -22,25 +35,97 @@ wa.getpass = pwinput
 if __name__ == "__main__":
     sys.stderr = open('error.log','a')
 
-# Humble endpoints
-HUMBLE_LOGIN_PAGE = "https://www.humblebundle.com/login"
-HUMBLE_KEYS_PAGE = "https://www.humblebundle.com/home/library"
-HUMBLE_SUB_PAGE = "https://www.humblebundle.com/subscription/"
-
-HUMBLE_LOGIN_API = "https://www.humblebundle.com/processlogin"
-HUMBLE_REDEEM_API = "https://www.humblebundle.com/humbler/redeemkey"
-HUMBLE_ORDERS_API = "https://www.humblebundle.com/api/v1/user/order"
-HUMBLE_ORDER_DETAILS_API = "https://www.humblebundle.com/api/v1/order/"
-HUMBLE_SUB_API = "https://www.humblebundle.com/api/v1/subscriptions/humble_monthly/subscription_products_with_gamekeys/"
+# Where the endpoints live, can be pointed at a local stand-in (see benchmarks/standin.py)
+HUMBLE_BASE_URL = os.environ.get("HUMBLE_BASE_URL", "https://www.humblebundle.com")
+STEAM_STORE_BASE_URL = os.environ.get("STEAM_STORE_BASE_URL", "https://store.steampowered.com")
+STEAM_API_BASE_URL = os.environ.get("STEAM_API_BASE_URL", "https://api.steampowered.com")
 
-HUMBLE_PAY_EARLY = "https://www.humblebundle.com/subscription/payearly"
-HUMBLE_CHOOSE_CONTENT = "https://www.humblebundle.com/humbler/choosecontent"
+# Humble endpoints
+HUMBLE_LOGIN_PAGE = f"{HUMBLE_BASE_URL}/login"
+HUMBLE_KEYS_PAGE = f"{HUMBLE_BASE_URL}/home/library"
+HUMBLE_SUB_PAGE = f"{HUMBLE_BASE_URL}/subscription/"
+
+HUMBLE_LOGIN_API = f"{HUMBLE_BASE_URL}/processlogin"
+HUMBLE_REDEEM_API = f"{HUMBLE_BASE_URL}/humbler/redeemkey"
+HUMBLE_ORDERS_API = f"{HUMBLE_BASE_URL}/api/v1/user/order"
+HUMBLE_ORDER_DETAILS_API = f"{HUMBLE_BASE_URL}/api/v1/order/"
+HUMBLE_SUB_API = f"{HUMBLE_BASE_URL}/api/v1/subscriptions/humble_monthly/subscription_products_with_gamekeys/"
+
+HUMBLE_PAY_EARLY = f"{HUMBLE_BASE_URL}/subscription/payearly"
+HUMBLE_CHOOSE_CONTENT = f"{HUMBLE_BASE_URL}/humbler/choosecontent"
+
+# Connections kept alive to humblebundle.com, also the number of order details fetched at once
+HUMBLE_MAX_CONNECTIONS = 8
+HUMBLE_TIMEOUT = 30 # seconds
+HUMBLE_RETRIES = 3
+HUMBLE_RETRY_DELAY = 2 # seconds, doubled after each retry
+HUMBLE_ORDER_BATCH = 25
+# How many keys get revealed on Humble ahead of the one being redeemed on Steam
+HUMBLE_REVEAL_LOOKAHEAD = 10
+# Keys revealed ahead that Steam hasn't had yet, so a stopped run doesn't leave them behind
+HUMBLE_REVEALED_AHEAD = ".revealedahead"
+# Parallel reveals when revealing everything in Export mode, with progress saved as they land
+HUMBLE_REVEAL_WORKERS = 4
+HUMBLE_REVEAL_CHECKPOINT = ".revealcheckpoint"
+
+# Parsed Humble Choice month pages, dropped when a choice is made
+HUMBLE_CHOICE_CACHE = ".humblechoices"
+HUMBLE_CHOICE_CACHE_MAX_AGE = 24 * 60 * 60 # seconds
+
+# Local copy of order details, only orders that can still change get downloaded again
+HUMBLE_ORDER_CACHE = ".humbleorders"
+HUMBLE_ORDER_CACHE_MAX_AGE = 30 * 24 * 60 * 60 # seconds
 
 # Steam endpoints
-STEAM_KEYS_PAGE = "https://store.steampowered.com/account/registerkey"
-STEAM_USERDATA_API = "https://store.steampowered.com/dynamicstore/userdata/"
-STEAM_REDEEM_API = "https://store.steampowered.com/account/ajaxregisterkey/"
-STEAM_APP_LIST_API = "https://api.steampowered.com/ISteamApps/GetAppList/v2/"
+STEAM_KEYS_PAGE = f"{STEAM_STORE_BASE_URL}/account/registerkey"
+STEAM_USERDATA_API = f"{STEAM_STORE_BASE_URL}/dynamicstore/userdata/"
+STEAM_REDEEM_API = f"{STEAM_STORE_BASE_URL}/account/ajaxregisterkey/"
+STEAM_APP_LIST_API = f"{STEAM_API_BASE_URL}/ISteamApps/GetAppList/v2/"
+STEAM_PACKAGE_DETAILS_API = f"{STEAM_STORE_BASE_URL}/api/packagedetails/"
+
+# STEAM_APP_LIST_API is tens of MB and rarely changes. It's kept as an appid -> name table in
+# SQLite, so owned apps get their names without the catalog ever being in memory.
+STEAM_APP_LIST_CACHE = ".steamapplist.db"
+APP_LIST_MAX_AGE = 7 * 24 * 60 * 60 # seconds
+STEAM_APP_LIST_CHUNK = 64 * 1024 # bytes
+APP_LIST_LOOKUP_BATCH = 500
+
+# Apps in each owned Steam package (sub), which don't change once a package exists.
+# The store API refuses after about 200 requests in 5 minutes, so new packages get looked up a batch per run.
+STEAM_PACKAGE_CACHE = ".steampackages"
+STEAM_PACKAGE_LOOKUPS = 150
+STEAM_PACKAGE_WORKERS = 4
+
+# Steam's activation limits: roughly 50 successful and 10 failed keys per hour.
+# Attempts are shared by every run on this machine, so it lives in the home folder.
+# The limits can be overridden to match a stand-in's throttling.
+STEAM_RATE_LIMIT_DB = os.path.join(os.path.expanduser("~"), ".humblesteamratelimit")
+STEAM_SUCCESS_LIMIT = int(os.environ.get("STEAM_SUCCESS_LIMIT", 50))
+STEAM_FAILURE_LIMIT = int(os.environ.get("STEAM_FAILURE_LIMIT", 10))
+STEAM_RATE_WINDOW = float(os.environ.get("STEAM_RATE_WINDOW", 60 * 60)) # seconds
+
+# Connections to Steam. Dropped connections, timeouts and error pages are retried, after
+# STEAM_BREAKER_FAILURES of them in a row Steam is left alone for STEAM_BREAKER_COOLDOWN.
+STEAM_MAX_CONNECTIONS = STEAM_PACKAGE_WORKERS
+STEAM_TIMEOUT = (10, 30) # seconds to connect, seconds to wait for a response
+STEAM_RETRIES = 3
+STEAM_RETRY_DELAY = 2 # seconds, doubled after each retry
+STEAM_BREAKER_FAILURES = 5
+STEAM_BREAKER_COOLDOWN = 5 * 60 # seconds
+
+# Every key the script has acted on, replaces the old redeemed/already_owned/errored CSVs
+LEDGER_DB = "redemptions.db"
+LEDGER_CSV_FILES = {"redeemed": "redeemed.csv", "already_owned": "already_owned.csv", "errored": "errored.csv"}
+LEDGER_CSV_HEADER = ["gamekey", "human_name", "redeemed_key_val", "code", "recorded"]
+LEDGER_COLUMNS = ["recorded", "code", "outcome", "gamekey", "keyindex", "machine_name", "human_name", "steam_app_id", "key_value"]
+
+# Fuzzy ownership decisions from previous runs, including answers given when filtering live
+MATCH_DECISION_CACHE = ".matchdecisions"
+
+# Where the time went in the last run, written when it ends. --prometheus-textfile <file> also
+# writes it for node_exporter's textfile collector, refreshed after every job in daemon mode.
+METRICS_FILE = "metrics.json"
+METRICS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30) # seconds
 
 # May actually be able to do without these, but for now they're in.
 headers = {
@@ -49,6 +134,176 @@ headers = {
 }
 
 
+def write_json_atomic(filename, data):
+    # Write then swap so an interrupted run never leaves half a file behind
+    tmp_file = filename + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(tmp_file, filename)
+
+
+class RunMetrics:
+    # Phase times add up every time a phase runs, from any thread, so overlapping work
+    # (reveals during Steam waits, parallel fetches) can add up to more than the run took.
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.buckets = buckets
+        self.phases = {}
+        self.requests = {}
+        self.steam_results = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                phase = self.phases.setdefault(name, {"seconds": 0, "count": 0})
+                phase["seconds"] += seconds
+                phase["count"] += 1
+
+    def record_request(self, endpoint, status, seconds):
+        with self.lock:
+            entry = self.requests.setdefault(
+                endpoint, {"count": 0, "seconds": 0, "statuses": {}, "buckets": [0] * len(self.buckets)}
+            )
+            entry["count"] += 1
+            entry["seconds"] += seconds
+            entry["statuses"][str(status)] = entry["statuses"].get(str(status), 0) + 1
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    entry["buckets"][i] += 1
+
+    def record_steam_result(self, code):
+        with self.lock:
+            self.steam_results[str(code)] = self.steam_results.get(str(code), 0) + 1
+
+    def summary(self):
+        with self.lock:
+            return json.loads(json.dumps({
+                "started": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(self.started)),
+                "seconds": time.time() - self.started,
+                "phases": self.phases,
+                "requests": self.requests,
+                "buckets": self.buckets,
+                "steam_results": self.steam_results,
+            }))
+
+    def prometheus(self):
+        summary = self.summary()
+        lines = [
+            "# HELP humble_redeemer_run_seconds Time since the run started",
+            "# TYPE humble_redeemer_run_seconds gauge",
+            f"humble_redeemer_run_seconds {summary['seconds']:.3f}",
+            "# HELP humble_redeemer_phase_seconds_total Time spent in each phase",
+            "# TYPE humble_redeemer_phase_seconds_total counter",
+        ]
+        lines += [
+            f'humble_redeemer_phase_seconds_total{{phase="{name}"}} {phase["seconds"]:.3f}'
+            for name, phase in summary["phases"].items()
+        ]
+        lines += [
+            "# HELP humble_redeemer_http_request_duration_seconds Request latency per endpoint",
+            "# TYPE humble_redeemer_http_request_duration_seconds histogram",
+        ]
+        for endpoint, entry in summary["requests"].items():
+            for bound, count in zip(summary["buckets"], entry["buckets"]):
+                lines.append(f'humble_redeemer_http_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+            lines += [
+                f'humble_redeemer_http_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {entry["count"]}',
+                f'humble_redeemer_http_request_duration_seconds_sum{{endpoint="{endpoint}"}} {entry["seconds"]:.3f}',
+                f'humble_redeemer_http_request_duration_seconds_count{{endpoint="{endpoint}"}} {entry["count"]}',
+            ]
+        lines += [
+            "# HELP humble_redeemer_http_responses_total Responses per endpoint and HTTP status",
+            "# TYPE humble_redeemer_http_responses_total counter",
+        ]
+        for endpoint, entry in summary["requests"].items():
+            lines += [
+                f'humble_redeemer_http_responses_total{{endpoint="{endpoint}",status="{status}"}} {count}'
+                for status, count in entry["statuses"].items()
+            ]
+        lines += [
+            "# HELP humble_redeemer_steam_results_total Steam key activation results by result code",
+            "# TYPE humble_redeemer_steam_results_total counter",
+        ]
+        lines += [
+            f'humble_redeemer_steam_results_total{{code="{code}"}} {count}'
+            for code, count in summary["steam_results"].items()
+        ]
+        return "\n".join(lines) + "\n"
+
+
+metrics = RunMetrics()
+prometheus_textfile = None
+
+
+def timed_phase(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with metrics.phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def endpoint_name(url):
+    # Order details and Choice pages are one endpoint each, whatever the gamekey or month
+    url = url.split("?")[0]
+    endpoints = [
+        ("humble_orders", HUMBLE_ORDERS_API),
+        ("humble_order_details", HUMBLE_ORDER_DETAILS_API),
+        ("humble_redeem", HUMBLE_REDEEM_API),
+        ("humble_choose_content", HUMBLE_CHOOSE_CONTENT),
+        ("humble_login", HUMBLE_LOGIN_API),
+        ("humble_library", HUMBLE_KEYS_PAGE),
+        ("humble_pay_early", HUMBLE_PAY_EARLY),
+        ("humble_choice_page", HUMBLE_SUB_PAGE),
+        ("steam_keys_page", STEAM_KEYS_PAGE),
+        ("steam_userdata", STEAM_USERDATA_API),
+        ("steam_redeem", STEAM_REDEEM_API),
+        ("steam_app_list", STEAM_APP_LIST_API),
+        ("steam_package_details", STEAM_PACKAGE_DETAILS_API),
+    ]
+    for name, endpoint in endpoints:
+        if url == endpoint or (endpoint.endswith("/") and url.startswith(endpoint)):
+            return name
+    # Steam's login API and anything else, by host
+    return url.split("/")[2] if "://" in url else "other"
+
+
+def instrument_session(session):
+    # Times every request the session makes, including reading the body and failed attempts
+    request = session.request
+
+    def timed_request(method, url, *args, **kwargs):
+        start = time.perf_counter()
+        status = "error"
+        try:
+            r = request(method, url, *args, **kwargs)
+            status = r.status_code
+            return r
+        finally:
+            metrics.record_request(endpoint_name(url), status, time.perf_counter() - start)
+
+    session.request = timed_request
+    return session
+
+
+def save_metrics():
+    write_json_atomic(METRICS_FILE, metrics.summary())
+    if prometheus_textfile:
+        # The textfile collector may read at any moment, same swap as write_json_atomic
+        tmp_file = prometheus_textfile + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            f.write(metrics.prometheus())
+        os.replace(tmp_file, prometheus_textfile)
+
+
 def find_dict_keys(node, kv, parent=False):
     if isinstance(node, list):
         for i in node:
@@ -64,43 +319,111 @@ def find_dict_keys(node, kv, parent=False):
             for x in find_dict_keys(j, kv, parent):
                 yield x
 
-getHumbleOrders = '''
-var done = arguments[arguments.length - 1];
-var list = '%optional%';
-if (list){
-    list = JSON.parse(list);
-} else {
-    list = [];
-}
-var getHumbleOrderDetails = async (list) => {
-  const HUMBLE_ORDERS_API_URL = 'https://www.humblebundle.com/api/v1/user/order';
-  const HUMBLE_ORDER_DETAILS_API = 'https://www.humblebundle.com/api/v1/order/';
-
-  try {
-    var orders = []
-    if(list.length){
-      orders = list.map(item => ({ gamekey: item }));
-    } else {
-      const response = await fetch(HUMBLE_ORDERS_API_URL);
-      orders = await response.json();
+KEY_INDEX_FIELDS = ("steam_app_id", "key_type_human_name", "gamekey", "machine_name")
+KEY_RECORD_FIELDS = (
+    "machine_name", "gamekey", "keyindex", "human_name", "key_type", "key_type_human_name",
+    "steam_app_id", "redeemed_key_val", "is_gift", "is_expired",
+)
+
+
+class KeyRecord:
+    # The parts of a Humble tpk the script uses, so the raw order tree (descriptions, images,
+    # downloads...) doesn't have to stay around for the whole run. Reads and writes like the
+    # tpk dict it came from: fields the tpk didn't have are missing here too.
+    __slots__ = KEY_RECORD_FIELDS
+
+    def __init__(self, tpk):
+        for field in KEY_RECORD_FIELDS:
+            if field in tpk:
+                setattr(self, field, tpk[field])
+
+    def __contains__(self, field):
+        return field in KEY_RECORD_FIELDS and hasattr(self, field)
+
+    def __getitem__(self, field):
+        if field not in self:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def __setitem__(self, field, value):
+        setattr(self, field, value)
+
+    def get(self, field, default=None):
+        return getattr(self, field) if field in self else default
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in KEY_RECORD_FIELDS if hasattr(self, field)}
+
+
+def build_key_index(order_details):
+    # Single pass over order -> tpkd_dict -> all_tpks, rather than walking the whole tree for every lookup.
+    # index["keys"] holds every key in library order, the other entries map a field's value to its keys.
+    # Keys are copied into KeyRecords, nothing in the index refers back into order_details.
+    index = {"keys": []}
+    for field in KEY_INDEX_FIELDS:
+        index[field] = {}
+    return add_to_key_index(index, order_details)
+
+
+def add_to_key_index(index, order_details):
+    for order in order_details:
+        for tpk in (order.get("tpkd_dict") or {}).get("all_tpks") or []:
+            key = KeyRecord(tpk)
+            index["keys"].append(key)
+            for field in KEY_INDEX_FIELDS:
+                if field in key:
+                    index[field].setdefault(key[field], []).append(key)
+    return index
+
+
+def sort_key_index(index, order_details):
+    # An index filled batch by batch has keys in the order the batches arrived, put them back in library order
+    position = {order["gamekey"]: i for i, order in enumerate(order_details)}
+    library_order = lambda key: position.get(key["gamekey"], len(position))
+    index["keys"].sort(key=library_order)
+    for field in KEY_INDEX_FIELDS:
+        for keys in index[field].values():
+            keys.sort(key=library_order)
+    return index
+
+
+def slim_order(order):
+    # Raw orders also carry subproducts, downloads, descriptions and images for everything in them.
+    # Keep what the script reads: the keys, and what the chooser and order_is_settled look at.
+    product = order.get("product") or {}
+    slim = {field: order[field] for field in ("gamekey", "created", "choices_remaining") if field in order}
+    slim["product"] = {
+        field: product[field] for field in ("machine_name", "human_name", "choice_url", "is_subs_v3_product") if field in product
     }
-    const orderDetailsPromises = orders.map(async (order) => {
-      const orderDetailsUrl = `${HUMBLE_ORDER_DETAILS_API}${order['gamekey']}?all_tpkds=true`;
-      const orderDetailsResponse = await fetch(orderDetailsUrl);
-      const orderDetails = await orderDetailsResponse.json();
-      return orderDetails;
-    });
-
-    const orderDetailsArray = await Promise.all(orderDetailsPromises);
-    return orderDetailsArray;
-  } catch (error) {
-    console.error('Error:', error);
-    return [];
-  }
-};
-
-getHumbleOrderDetails(list).then(r => {done(r)});
-'''
+    slim["tpkd_dict"] = {"all_tpks": [
+        {field: tpk[field] for field in KEY_RECORD_FIELDS if field in tpk}
+        for tpk in (order.get("tpkd_dict") or {}).get("all_tpks") or []
+    ]}
+    return slim
+
+
+def choice_months(order_details):
+    # Just what the chooser needs from the Humble Choice orders, the rest of the tree can go
+    return [
+        {
+            "gamekey": order["gamekey"],
+            "created": order["created"],
+            "choices_remaining": order.get("choices_remaining", 0),
+            "product": {
+                field: order["product"][field]
+                for field in ("human_name", "choice_url", "is_subs_v3_product")
+                if field in order["product"]
+            },
+        }
+        for order in order_details
+        if "choice_url" in order["product"]
+    ]
+
+
+def indexed_keys(index, field):
+    # Keys that have field at all, in library order (same as find_dict_keys(..., field, True))
+    return [tpk for tpk in index["keys"] if field in tpk]
+
 
 fetch_cmd = '''
 var done = arguments[arguments.length - 1];
@@ -108,7 +431,9 @@ var formData = new FormData();
 const jsonData = JSON.parse(atob('{formData}'));
 
 for (const key in jsonData) {{
-    formData.append(key,jsonData[key])
+    for (const value of [].concat(jsonData[key])) {{
+        formData.append(key,value)
+    }}
 }}
 
 fetch("{url}", {{
@@ -120,7 +445,193 @@ fetch("{url}", {{
 }}).then(r => {{ r.json().then( v=>{{done([r.status,v])}} ) }} );
 '''
 
+class HumbleSession(requests.Session):
+    # Plain HTTP session for the Humble API, using the cookies from a browser login.
+    # Mirrors the WebDriver cookie methods so the cookie helpers work with either.
+    def __init__(self, max_connections=HUMBLE_MAX_CONNECTIONS):
+        super().__init__()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+        self.headers.update({"Accept": headers["Accept"]})
+        instrument_session(self)
+
+    @classmethod
+    def from_driver(cls, driver):
+        session = cls()
+        for cookie in driver.get_cookies():
+            session.add_cookie(cookie)
+        return session
+
+    def add_cookie(self, cookie):
+        self.cookies.set(cookie['name'],cookie['value'],domain=cookie['domain'].replace('www.',''),path=cookie['path'])
+
+    def get_cookie(self, name):
+        for cookie in self.get_cookies():
+            if cookie["name"] == name:
+                return cookie
+        return None
+
+    def get_cookies(self):
+        return [
+            {"name": c.name, "value": c.value, "domain": c.domain, "path": c.path, "secure": c.secure}
+            for c in self.cookies
+        ]
+
+    def post_form(self, url, payload):
+        csrf = self.get_cookie('csrf_cookie')
+        csrf = csrf['value'] if csrf is not None else ''
+        try:
+            r = self.post(url, data=payload, headers={"csrf-prevention-token": csrf}, timeout=HUMBLE_TIMEOUT)
+        except requests.Timeout:
+            # Reported like any other failed request, a hung socket mustn't stall the reveal thread
+            return [None, {"success": False, "error_msg": f"Humble didn't answer within {HUMBLE_TIMEOUT} seconds"}]
+        except requests.RequestException as e:
+            # Dropped connections too. Not retried, a choice or reveal may already have gone through.
+            return [None, {"success": False, "error_msg": f"Couldn't reach Humble ({e.__class__.__name__})"}]
+        try:
+            return [r.status_code, r.json()]
+        except ValueError:
+            return [r.status_code, {"success": False, "error_msg": f"Unexpected response (HTTP status code {r.status_code})"}]
+
+
+def humble_get_json(humble_session, url, retries=HUMBLE_RETRIES):
+    # Retries throttling, server errors and dropped connections with backoff, other errors are final
+    for attempt in range(retries + 1):
+        try:
+            r = humble_session.get(url, timeout=HUMBLE_TIMEOUT)
+            if r.status_code == 429 or r.status_code >= 500:
+                raise requests.HTTPError(f"HTTP status code {r.status_code}", response=r)
+            if r.ok:
+                return r.json()
+        except (requests.RequestException, ValueError):
+            if attempt == retries:
+                raise
+            time.sleep(HUMBLE_RETRY_DELAY * 2 ** attempt + random.uniform(0, HUMBLE_RETRY_DELAY))
+            continue
+        r.raise_for_status()
+
+
+def get_humble_gamekeys(humble_session):
+    return [order["gamekey"] for order in humble_get_json(humble_session, HUMBLE_ORDERS_API)]
+
+
+def iter_humble_orders(humble_session, gamekeys=None, concurrency=HUMBLE_MAX_CONNECTIONS, batch_size=HUMBLE_ORDER_BATCH, progress=True):
+    # Yields batches of order details as they arrive. Orders that still fail after
+    # retrying are left out rather than losing the whole library.
+    if gamekeys is None:
+        gamekeys = get_humble_gamekeys(humble_session)
+
+    failed = []
+    batch = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(humble_get_json, humble_session, f"{HUMBLE_ORDER_DETAILS_API}{gamekey}?all_tpkds=true"): gamekey
+            for gamekey in gamekeys
+        }
+        try:
+            for future in as_completed(futures):
+                try:
+                    batch.append(future.result())
+                except (requests.RequestException, ValueError) as e:
+                    failed.append(futures[future])
+                    print(f"Couldn't get order {futures[future]}: {e}", file=sys.stderr)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+        finally:
+            # Consumer stopped early, don't fetch the rest
+            for future in futures:
+                future.cancel()
+    if batch:
+        yield batch
+    if failed:
+        # Still worth knowing about without progress output, so that goes to the error log instead
+        print(
+            f"\nCouldn't get {len(failed)} of {len(gamekeys)} orders from Humble, their keys will be missing this run.",
+            file=sys.stdout if progress else sys.stderr,
+        )
+
+
+def order_is_settled(order):
+    # Once every key is revealed (or expired) and there's nothing left to choose, an order stops changing
+    product = order.get("product") or {}
+    if "choice_url" in product and (order.get("choices_remaining", 0) > 0 or product.get("is_subs_v3_product", False)):
+        return False
+    for tpk in (order.get("tpkd_dict") or {}).get("all_tpks") or []:
+        if "redeemed_key_val" not in tpk and not tpk.get("is_expired", False):
+            return False
+    return True
+
+
+def load_order_cache(cache_file=HUMBLE_ORDER_CACHE):
+    try:
+        with open(cache_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+@timed_phase("order_fetch")
+def get_humble_orders(humble_session, gamekeys=None, refresh=False, cache_file=HUMBLE_ORDER_CACHE, progress=True, on_batch=None):
+    # Order details (see slim_order) for every order on the account, or just the given gamekeys.
+    # on_batch gets the orders as they become available: the saved ones first, then each fetched batch.
+    full_library = gamekeys is None
+    if full_library:
+        gamekeys = get_humble_gamekeys(humble_session)
+
+    cache = load_order_cache(cache_file)
+    for entry in cache.values():
+        # Caches from before orders were slimmed
+        entry["details"] = slim_order(entry["details"])
+    now = time.time()
+    outdated = [
+        gamekey for gamekey in gamekeys
+        if refresh
+        or gamekey not in cache
+        or not cache[gamekey]["settled"]
+        or now - cache[gamekey]["fetched"] > HUMBLE_ORDER_CACHE_MAX_AGE
+    ]
+    if progress and len(outdated) < len(gamekeys):
+        print(f"Using saved details for {len(gamekeys) - len(outdated)} unchanged orders")
+    if on_batch is not None:
+        outdated_keys = set(outdated)
+        on_batch([cache[gamekey]["details"] for gamekey in gamekeys if gamekey in cache and gamekey not in outdated_keys])
+
+    fetched = 0
+    for batch in iter_humble_orders(humble_session, outdated, progress=progress):
+        for order in batch:
+            cache[order["gamekey"]] = {"fetched": now, "settled": order_is_settled(order), "details": slim_order(order)}
+        if on_batch is not None:
+            on_batch([cache[order["gamekey"]]["details"] for order in batch])
+        fetched += len(batch)
+        if progress:
+            print(f"Got {fetched} of {len(outdated)} orders", end="\r")
+    if progress:
+        print()
+
+    if full_library:
+        # Forget orders that are no longer on the account
+        cache = {gamekey: cache[gamekey] for gamekey in gamekeys if gamekey in cache}
+    write_json_atomic(cache_file, cache)
+
+    # Keep Humble's order, batches arrive in whatever order they finish
+    return [cache[gamekey]["details"] for gamekey in gamekeys if gamekey in cache]
+
+
+def get_humble_keys(humble_session, refresh=False, progress=True):
+    # (order_details, key_index), with keys indexed batch by batch while later orders are still downloading
+    key_index = build_key_index([])
+    order_details = get_humble_orders(
+        humble_session, refresh=refresh, progress=progress, on_batch=lambda batch: add_to_key_index(key_index, batch)
+    )
+    return order_details, sort_key_index(key_index, order_details)
+
+
 def perform_post(driver,url,payload):
+    if isinstance(driver, HumbleSession):
+        return driver.post_form(url, payload)
+
     json_payload = b64encode(json.dumps(payload).encode('utf-8')).decode('ascii')
     csrf = driver.get_cookie('csrf_cookie')
     csrf = csrf['value'] if csrf is not None else ''
@@ -130,13 +641,30 @@ def perform_post(driver,url,payload):
 
     return driver.execute_async_script(fetch_cmd.format(formData=json_payload,url=url,csrf=csrf))
 
-def process_quit(driver):
-    def quit_on_exit(*args):
-        driver.quit()
+quit_hooks = []
+
+
+def run_quit_hooks():
+    while quit_hooks:
+        try:
+            quit_hooks.pop()()
+        except Exception:
+            # Already closed
+            pass
+
 
-    atexit.register(quit_on_exit)
-    signal.signal(signal.SIGTERM,quit_on_exit)
-    signal.signal(signal.SIGINT,quit_on_exit)
+def quit_on_signal(signum, frame):
+    run_quit_hooks()
+    sys.exit(128 + signum)
+
+
+def process_quit(quit):
+    # Makes sure quit gets called when we close, including on SIGTERM/SIGINT
+    if not quit_hooks:
+        atexit.register(run_quit_hooks)
+        signal.signal(signal.SIGTERM,quit_on_signal)
+        signal.signal(signal.SIGINT,quit_on_signal)
+    quit_hooks.append(quit)
 
 def get_headless_driver():
     possibleDrivers = [(webdriver.Firefox,webdriver.FirefoxOptions),(webdriver.Chrome,webdriver.ChromeOptions)]
@@ -151,7 +679,7 @@ def get_headless_driver():
             else:
                 options.add_argument("-headless")
             driver = d(options=options)
-            process_quit(driver) # make sure driver closes when we close
+            process_quit(driver.quit) # make sure driver closes when we close
             return driver
         except WebDriverException as e:
             exceptions.append(('chrome:' if d == webdriver.Chrome else 'firefox:',e))
@@ -176,7 +704,7 @@ Which key export mode would you like to use?
 [2] Export keys
 [3] Humble Choice chooser
 """
-def prompt_mode(order_details,humble_session):
+def prompt_mode():
     mode = None
     while mode not in ["1","2","3"]:
         print(MODE_PROMPT)
@@ -231,19 +759,26 @@ def export_cookies(cookie_file, session):
 is_logged_in = '''
 var done = arguments[arguments.length-1];
 
-fetch("https://www.humblebundle.com/home/library").then(r => {done(!r.redirected)})
-'''
+fetch("%s").then(r => {done(!r.redirected)})
+''' % HUMBLE_KEYS_PAGE
 
 def verify_logins_session(session):
     # Returns [humble_status, steam_status]
-    if type(session) is requests.Session:
-        loggedin = session.get(STEAM_KEYS_PAGE, allow_redirects=False).status_code not in (301,302)
+    if isinstance(session, HumbleSession):
+        loggedin = session.get(HUMBLE_KEYS_PAGE, allow_redirects=False, timeout=HUMBLE_TIMEOUT).status_code not in (301,302)
+        return [loggedin,False]
+    elif type(session) is requests.Session:
+        loggedin = session.get(STEAM_KEYS_PAGE, allow_redirects=False, timeout=STEAM_TIMEOUT).status_code not in (301,302)
         return [False,loggedin]
     else:
         return [session.execute_async_script(is_logged_in),False]
 
 def do_login(driver,payload):
         auth,login_json = perform_post(driver,HUMBLE_LOGIN_API,payload)
+        if auth is None:
+            print(login_json["error_msg"])
+            time.sleep(30)
+            sys.exit()
         if auth not in (200,401):
             print(f"humblebundle.com has responded with an error (HTTP status code {auth}: {responses[auth]}).")
             time.sleep(30)
@@ -318,22 +853,102 @@ def humble_login(driver):
         return True
 
 
-def steam_login():
+@timed_phase("login")
+def get_humble_session(interactive=True):
+    # A saved session can be checked over plain HTTP, only launch a browser when we need to log in
+    session = HumbleSession()
+    if try_recover_cookies(".humblecookies", session) and verify_logins_session(session)[0]:
+        return session
+    if not interactive:
+        print("The saved Humble session has expired, run the script normally once to sign in again.")
+        sys.exit(1)
+
+    driver = get_headless_driver()
+    humble_login(driver)
+    session = HumbleSession.from_driver(driver)
+    # Everything past login talks to Humble directly, the browser is no longer needed
+    driver.quit()
+    return session
+
+
+def steam_session_setup(session):
+    # Keep-alive pool sized for the package lookups, and request metrics
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=STEAM_MAX_CONNECTIONS)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return instrument_session(session)
+
+
+@timed_phase("login")
+def steam_login(interactive=True):
     # Sign into Steam web
 
     # Attempt to use saved session
-    r = requests.Session()
-    if try_recover_cookies(".steamcookies", r) and verify_logins_session(r)[1]:
+    r = saved_steam_session()
+    if r is not None:
         return r
+    if not interactive:
+        print("The saved Steam session has expired, run the script normally once to sign in again.")
+        sys.exit(1)
 
     # Saved state doesn't work, prompt user to sign in.
     s_username = input("Steam Username: ")
     user = wa.WebAuth(s_username)
-    session = user.cli_login()
+    session = steam_session_setup(user.cli_login())
     export_cookies(".steamcookies", session)
     return session
 
 
+def saved_steam_session():
+    # The saved Steam session if it's still signed in, never asks for anything
+    session = steam_session_setup(requests.Session())
+    if try_recover_cookies(".steamcookies", session) and verify_logins_session(session)[1]:
+        return session
+    return None
+
+
+def in_background(function, *args, **kwargs):
+    # Like executor.submit, but a daemon thread, so exiting doesn't wait on work nobody needed
+    future = Future()
+
+    def run():
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(function(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+def preload_steam():
+    # Loads Steam ownership while Humble orders download and prompts get answered. Only a saved
+    # session can be used here, a fresh login waits until a mode asks for it.
+    # Returns (steam_session, owned_app_details), either may be None.
+    session = None
+    try:
+        session = saved_steam_session()
+        if session is None:
+            return None, None
+        # Quiet, the user is answering prompts meanwhile
+        return session, get_owned_apps(session, progress=False)
+    except (requests.RequestException, ValueError, KeyError) as e:
+        print(f"Couldn't load Steam ownership in the background: {e}", file=sys.stderr)
+        return session, None
+
+
+def steam_ownership(steam_preload=None):
+    # (steam_session, owned_app_details) from preload_steam, signing in or loading what's missing
+    session, owned_app_details = steam_preload.result() if steam_preload is not None else (None, None)
+    if session is None:
+        session = steam_login()
+    if owned_app_details is None and verify_logins_session(session)[1]:
+        owned_app_details = get_owned_apps(session)
+    return session, owned_app_details
+
+
+@timed_phase("reveal")
 def redeem_humble_key(sess, tpk):
     # Keys need to be 'redeemed' on Humble first before the Humble API gives the user a Steam key.
     # This triggers that for a given Humble key entry
@@ -351,19 +966,185 @@ def redeem_humble_key(sess, tpk):
         return respjson
 
 
+def reveal_ahead(humble_session, keys, lookahead=HUMBLE_REVEAL_LOOKAHEAD, record_file=HUMBLE_REVEALED_AHEAD):
+    # Yields keys in order with "redeemed_key_val" filled in. Revealing happens on a background
+    # thread up to lookahead keys ahead, so it carries on while Steam makes us wait.
+    # Each reveal is appended to record_file, see load_revealed_ahead.
+    revealed = queue.Queue(maxsize=lookahead)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                revealed.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def reveal():
+        try:
+            with open(record_file, "a", encoding="utf-8") as record:
+                for key in keys:
+                    if stop.is_set():
+                        return
+                    if "redeemed_key_val" not in key:
+                        # This key is unredeemed via Humble, trigger redemption process.
+                        key["redeemed_key_val"] = redeem_humble_key(humble_session, key)
+                        if key["redeemed_key_val"]:
+                            record.write(json.dumps({
+                                "gamekey": key["gamekey"],
+                                "keyindex": key["keyindex"],
+                                "redeemed_key_val": key["redeemed_key_val"],
+                            }) + "\n")
+                            record.flush()
+                    put(key)
+        except Exception as e:
+            put(e)
+        put(None)
+
+    thread = threading.Thread(target=reveal, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = revealed.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+def load_reveal_checkpoint(checkpoint_file=HUMBLE_REVEAL_CHECKPOINT):
+    revealed = {}
+    try:
+        with open(checkpoint_file, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Interrupted mid-write
+                    continue
+                revealed[(entry["gamekey"], entry["keyindex"])] = entry["redeemed_key_val"]
+    except OSError:
+        pass
+    return revealed
+
+
+def load_revealed_ahead(done_key_values, record_file=HUMBLE_REVEALED_AHEAD):
+    # {(gamekey, keyindex): key} for keys reveal_ahead revealed that never got a result from Steam.
+    # Ones that did (done_key_values, from the ledger) are dropped from the file.
+    revealed = {
+        position: key_value for position, key_value in load_reveal_checkpoint(record_file).items()
+        if key_value not in done_key_values
+    }
+    if revealed:
+        with open(record_file + ".tmp", "w", encoding="utf-8") as f:
+            for (gamekey, keyindex), key_value in revealed.items():
+                f.write(json.dumps({"gamekey": gamekey, "keyindex": keyindex, "redeemed_key_val": key_value}) + "\n")
+        os.replace(record_file + ".tmp", record_file)
+    elif os.path.exists(record_file):
+        os.remove(record_file)
+    return revealed
+
+
+def bulk_reveal(humble_session, tpks, workers=HUMBLE_REVEAL_WORKERS, checkpoint_file=HUMBLE_REVEAL_CHECKPOINT):
+    # Reveals tpks a few at a time over the pooled session. Each result is appended to the
+    # checkpoint as it arrives, so an interrupted run picks up where it stopped.
+    saved = load_reveal_checkpoint(checkpoint_file)
+    pending = []
+    for tpk in tpks:
+        if saved.get((tpk["gamekey"], tpk["keyindex"])):
+            tpk["redeemed_key_val"] = saved[(tpk["gamekey"], tpk["keyindex"])]
+        else:
+            pending.append(tpk)
+    if len(pending) < len(tpks):
+        print(f"Resuming, {len(tpks) - len(pending)} keys were revealed last time")
+
+    with open(checkpoint_file, "a", encoding="utf-8") as checkpoint, ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(redeem_humble_key, humble_session, tpk): tpk for tpk in pending}
+        for count, future in enumerate(as_completed(futures), 1):
+            tpk = futures[future]
+            try:
+                tpk["redeemed_key_val"] = future.result()
+            except (requests.RequestException, ValueError) as e:
+                # Left out of the checkpoint, so it's tried again next time
+                print("Error redeeming key on Humble for " + tpk["human_name"], file=sys.stderr)
+                print(e, file=sys.stderr)
+                tpk["redeemed_key_val"] = ""
+            if tpk["redeemed_key_val"]:
+                checkpoint.write(json.dumps({
+                    "gamekey": tpk["gamekey"],
+                    "keyindex": tpk["keyindex"],
+                    "redeemed_key_val": tpk["redeemed_key_val"],
+                }) + "\n")
+                checkpoint.flush()
+            print(f"Revealed {count} of {len(pending)} keys", end="\r")
+    if pending:
+        print()
+
+
 def get_month_data(humble_session,month):
     # No real API for this, seems to just be served on the webpage.
-    if type(humble_session) is not requests.Session:
+    if not isinstance(humble_session, requests.Session):
         raise Exception("get_month_data needs a configured requests session")
-    r = humble_session.get(HUMBLE_SUB_PAGE + month["product"]["choice_url"])
+    r = humble_session.get(HUMBLE_SUB_PAGE + month["product"]["choice_url"], timeout=HUMBLE_TIMEOUT)
+    return extract_month_data(r.text)["contentChoiceOptions"]
 
-    data_indicator = f'<script id="webpack-monthly-product-data" type="application/json">'
-    jsondata = r.text.split(data_indicator)[1].split("</script>")[0].strip()
-    jsondata = json.loads(jsondata)
-    return jsondata["contentChoiceOptions"]
 
+def extract_month_data(html):
+    # Scan once for the data blob and stop at its closing tag
+    data_indicator = '<script id="webpack-monthly-product-data" type="application/json">'
+    start = html.find(data_indicator)
+    if start == -1:
+        raise ValueError("Humble Choice page is missing its monthly product data")
+    start += len(data_indicator)
+    end = html.find("</script>", start)
+    return json.loads(html[start:end])
+
+
+def load_choice_cache(cache_file=HUMBLE_CHOICE_CACHE):
+    try:
+        with open(cache_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def forget_month_data(choice_url, cache_file=HUMBLE_CHOICE_CACHE):
+    # Choosing changes what the month page offers
+    cache = load_choice_cache(cache_file)
+    if cache.pop(choice_url, None) is not None:
+        write_json_atomic(cache_file, cache)
+
+
+@timed_phase("choice_pages")
+def get_months_data(humble_session, months, chosen, cache_file=HUMBLE_CHOICE_CACHE):
+    # contentChoiceOptions for each month by choice_url, fetching the ones not cached in parallel.
+    # A month's entry is only reused while its remaining and already chosen games are unchanged.
+    cache = load_choice_cache(cache_file)
+    now = time.time()
+
+    def marker(month):
+        return [month["choices_remaining"], sorted(chosen[month["gamekey"]])]
+
+    outdated = [
+        month for month in months
+        if month["product"]["choice_url"] not in cache
+        or cache[month["product"]["choice_url"]]["marker"] != marker(month)
+        or now - cache[month["product"]["choice_url"]]["fetched"] > HUMBLE_CHOICE_CACHE_MAX_AGE
+    ]
+    if outdated:
+        with ThreadPoolExecutor(max_workers=HUMBLE_MAX_CONNECTIONS) as executor:
+            month_data = executor.map(lambda month: get_month_data(humble_session, month), outdated)
+            for month, data in zip(outdated, month_data):
+                cache[month["product"]["choice_url"]] = {"fetched": now, "marker": marker(month), "data": data}
+        write_json_atomic(cache_file, cache)
+    return {month["product"]["choice_url"]: cache[month["product"]["choice_url"]]["data"] for month in months}
 
-def get_choices(humble_session,order_details):
+
+def get_choices(humble_session,order_details,key_index=None):
     months = [
         month for month in order_details 
         if "choice_url" in month["product"] 
@@ -371,148 +1152,512 @@ def get_choices(humble_session,order_details):
 
     # Oldest to Newest order
     months = sorted(months,key=lambda m: m["created"])
-    request_session = requests.Session()
-    for cookie in humble_session.get_cookies():
+    if isinstance(humble_session, HumbleSession):
+        request_session = humble_session
+    else:
         # convert cookies to requests
-        request_session.cookies.set(cookie['name'],cookie['value'],domain=cookie['domain'].replace('www.',''),path=cookie['path'])
+        request_session = HumbleSession.from_driver(humble_session)
+
+    if key_index is None:
+        key_index = build_key_index(months)
+
+    months = [
+        month for month in months
+        if month["choices_remaining"] > 0 or month["product"].get("is_subs_v3_product",False) # subs v3 products don't advertise choices, need to get them exhaustively
+    ]
+    chosen = {
+        month["gamekey"]: set(tpk["machine_name"] for tpk in key_index["gamekey"].get(month["gamekey"],[]))
+        for month in months
+    }
+    month_data = get_months_data(request_session,months,chosen)
 
-    choices = []
     for month in months:
-        if month["choices_remaining"] > 0 or month["product"].get("is_subs_v3_product",False): # subs v3 products don't advertise choices, need to get them exhaustively
-            chosen_games = set(find_dict_keys(month["tpkd_dict"],"machine_name"))
+        chosen_games = chosen[month["gamekey"]]
 
-            month["choice_data"] = get_month_data(request_session,month)
-            if not month["choice_data"].get('canRedeemGames',True):
-                month["available_choices"] = []
-                continue
+        month["choice_data"] = month_data[month["product"]["choice_url"]]
+        if not month["choice_data"].get('canRedeemGames',True):
+            month["available_choices"] = []
+            continue
 
-            v3 = not month["choice_data"].get("usesChoices",True)
-            
-            # Needed for choosing
-            if v3:
-                identifier = "initial"
-                choice_options = month["choice_data"]["contentChoiceData"]["game_data"]
-            else:
-                identifier = "initial" if "initial" in month["choice_data"]["contentChoiceData"] else "initial-classic"
-            
-                if identifier not in month["choice_data"]["contentChoiceData"]:
-                    for key in month["choice_data"]["contentChoiceData"].keys():
-                        if "content_choices" in month["choice_data"]["contentChoiceData"][key]:
-                            identifier = key
-
-                choice_options = month["choice_data"]["contentChoiceData"][identifier]["content_choices"]
-
-            # Exclude games that have already been chosen:
-            month["available_choices"] = [
-                    game[1]
-                    for game in choice_options.items()
-                    if set(find_dict_keys(game[1],"machine_name")).isdisjoint(chosen_games)
-            ]
-            
-            month["parent_identifier"] = identifier
-            if len(month["available_choices"]):
-                yield month
+        v3 = not month["choice_data"].get("usesChoices",True)
+        
+        # Needed for choosing
+        if v3:
+            identifier = "initial"
+            choice_options = month["choice_data"]["contentChoiceData"]["game_data"]
+        else:
+            identifier = "initial" if "initial" in month["choice_data"]["contentChoiceData"] else "initial-classic"
+        
+            if identifier not in month["choice_data"]["contentChoiceData"]:
+                for key in month["choice_data"]["contentChoiceData"].keys():
+                    if "content_choices" in month["choice_data"]["contentChoiceData"][key]:
+                        identifier = key
+
+            choice_options = month["choice_data"]["contentChoiceData"][identifier]["content_choices"]
+
+        # Exclude games that have already been chosen:
+        month["available_choices"] = [
+                game[1]
+                for game in choice_options.items()
+                if set(find_dict_keys(game[1],"machine_name")).isdisjoint(chosen_games)
+        ]
+        
+        month["parent_identifier"] = identifier
+        if len(month["available_choices"]):
+            yield month
+
+
+class SteamUnavailable(Exception):
+    # Steam couldn't be reached, or has been failing and shouldn't be tried again before retry_at.
+    # sent is whether the key may have reached Steam anyway.
+    def __init__(self, message, retry_at, sent=False):
+        super().__init__(message)
+        self.retry_at = retry_at
+        self.sent = sent
+
+
+class CircuitBreaker:
+    # Opens after too many transport failures in a row. Once the cooldown is over calls go
+    # through again, and a single further failure opens it for another cooldown.
+    def __init__(self, failures=STEAM_BREAKER_FAILURES, cooldown=STEAM_BREAKER_COOLDOWN):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.failed = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def retry_at(self):
+        # When calls may go through again, None if they can now
+        with self.lock:
+            if self.opened_at is None or time.time() >= self.opened_at + self.cooldown:
+                return None
+            return self.opened_at + self.cooldown
+
+    def success(self):
+        with self.lock:
+            self.failed = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self.lock:
+            self.failed = self.failed + 1
+            if self.failed >= self.failures:
+                self.opened_at = time.time()
+
+
+steam_breaker = CircuitBreaker()
+
+
+def steam_may_have_taken(error):
+    # Whether Steam could have got the key before this failure. Not if we never connected or it
+    # throttled us, but a server error or an error page in place of an answer may come after.
+    if isinstance(error, ValueError):
+        return True
+    if isinstance(error, requests.HTTPError):
+        return error.response.status_code >= 500
+    if isinstance(error, requests.ConnectTimeout):
+        return False
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return not isinstance(reason, ConnectTimeoutError)
+
+
+def steam_post_json(session, url, data, retries=STEAM_RETRIES, breaker=steam_breaker):
+    # Retries dropped connections, timeouts, throttling, server errors and error pages with backoff.
+    # Any JSON answer is final, retrying a result code would only spend more of the activation budget.
+    # A key that went through before its response got lost comes back as already owned on the retry.
+    sent = False
+    for attempt in range(retries + 1):
+        retry_at = breaker.retry_at()
+        if retry_at is not None:
+            raise SteamUnavailable(
+                f"Steam has failed {breaker.failed} times in a row, trying again at "
+                f"{time.strftime('%H:%M:%S', time.localtime(retry_at))}",
+                retry_at,
+                sent,
+            )
+        try:
+            r = session.post(url, data=data, timeout=STEAM_TIMEOUT)
+            if r.status_code == 429 or r.status_code >= 500:
+                raise requests.HTTPError(f"HTTP status code {r.status_code}", response=r)
+            if r.ok:
+                blob = r.json()
+                breaker.success()
+                return blob
+        except (requests.RequestException, ValueError) as e:
+            breaker.failure()
+            sent = sent or steam_may_have_taken(e)
+            if attempt == retries:
+                raise SteamUnavailable(f"Couldn't reach Steam: {e}", breaker.retry_at() or time.time(), sent) from e
+            time.sleep(STEAM_RETRY_DELAY * 2 ** attempt + random.uniform(0, STEAM_RETRY_DELAY))
+            continue
+        try:
+            return r.json()
+        except ValueError:
+            # Not a result code either, most likely the Steam session has expired. Retrying now won't help.
+            raise SteamUnavailable(
+                f"Steam answered with HTTP status code {r.status_code}, trying again in "
+                f"{STEAM_BREAKER_COOLDOWN // 60} minutes. If this keeps happening, sign into Steam again.",
+                time.time() + STEAM_BREAKER_COOLDOWN,
+                sent,
+            )
 
 
+# What ajaxregisterkey's result codes mean: the kind of outcome, and Steam's message for it
+STEAM_RESULT_CODES = {
+    0: ("redeemed", None),
+    9: (
+        "already_owned",
+        "This Steam account already owns the product(s) contained in this offer. To access them, "
+        "visit your library in the Steam client. ",
+    ),
+    13: (
+        "region_locked",
+        "Sorry, but this product is not available for purchase in this country. Your product key "
+        "has not been redeemed. ",
+    ),
+    14: (
+        "invalid_key",
+        "The product code you've entered is not valid. Please double check to see if you've "
+        "mistyped your key. I, L, and 1 can look alike, as can V and Y, and 0 and O. ",
+    ),
+    15: (
+        "used_elsewhere",
+        "The product code you've entered has already been activated by a different Steam account. "
+        "This code cannot be used again. Please contact the retailer or online seller where the "
+        "code was purchased for assistance. ",
+    ),
+    24: (
+        "requires_base_game",
+        "The product code you've entered requires ownership of another product before "
+        "activation.\n\nIf you are trying to activate an expansion pack or downloadable content, "
+        "please first activate the original game, then activate this additional content. ",
+    ),
+    36: (
+        "requires_ps3",
+        "The product code you have entered requires that you first play this game on the "
+        "PlayStation®3 system before it can be registered.\n\nPlease:\n\n- Start this game on "
+        "your PlayStation®3 system\n\n- Link your Steam account to your PlayStation®3 Network "
+        "account\n\n- Connect to Steam while playing this game on the PlayStation®3 system\n\n- "
+        "Register this product code through Steam. ",
+    ),
+    50: (
+        "wallet_code",
+        "The code you have entered is from a Steam Gift Card or Steam Wallet Code. Browse here: "
+        "https://store.steampowered.com/account/redeemwalletcode to redeem it. ",
+    ),
+    53: (
+        "rate_limited",
+        "There have been too many recent activation attempts from this account or Internet "
+        "address. Please wait and try your product code again later. ",
+    ),
+}
+STEAM_UNKNOWN_RESULT = (
+    "unknown",
+    "An unexpected error has occurred.  Your product code has not been redeemed.  Please wait "
+    "30 minutes and try redeeming the code again.  If the problem persists, please contact <a "
+    'href="https://help.steampowered.com/en/wizard/HelpWithCDKey">Steam Support</a> for '
+    "further assistance. ",
+)
+
+SteamResult = collections.namedtuple("SteamResult", ["code", "kind", "message", "items"])
+
+
+def steam_result(blob):
+    # Turns an ajaxregisterkey response into a SteamResult
+    if blob.get("success") == 1:
+        items = [item["line_item_description"] for item in blob["purchase_receipt_info"]["line_items"]]
+        return SteamResult(0, "redeemed", None, items)
+
+    error_code = blob.get("purchase_result_details")
+    if error_code == None:
+        # Sometimes purchase_result_details isn't there for some reason, try alt method
+        error_code = blob.get("purchase_receipt_info")
+        if error_code != None:
+            error_code = error_code.get("result_detail")
+    error_code = error_code or 53
+    kind, message = STEAM_RESULT_CODES.get(error_code, STEAM_UNKNOWN_RESULT)
+    return SteamResult(error_code, kind, message, [])
+
+
+@timed_phase("redeem")
 def _redeem_steam(session, key, quiet=False):
     # Based on https://gist.github.com/snipplets/2156576c2754f8a4c9b43ccb674d5a5d
     if key == "":
-        return 0
+        return SteamResult(0, "redeemed", None, [])
     session_id = session.cookies.get_dict()["sessionid"]
-    r = session.post(STEAM_REDEEM_API, data={"product_key": key, "sessionid": session_id})
-    blob = r.json()
+    result = steam_result(steam_post_json(session, STEAM_REDEEM_API, {"product_key": key, "sessionid": session_id}))
+    metrics.record_steam_result(result.code)
+
+    for item in result.items:
+        print("Redeemed " + item)
+    if result.message is not None and (result.kind != "rate_limited" or not quiet):
+        print(result.message)
+    return result
+
+
+class SteamRateLimiter:
+    # Two token buckets, successes and failures, where a spent token comes back one window later.
+    # Attempts are stored in SQLite so separate runs and processes draw from the same budgets.
+    # An attempt in flight counts against both until its result is recorded.
+    def __init__(self, filename=STEAM_RATE_LIMIT_DB, success_limit=STEAM_SUCCESS_LIMIT,
+                 failure_limit=STEAM_FAILURE_LIMIT, window=STEAM_RATE_WINDOW):
+        self.success_limit = success_limit
+        self.failure_limit = failure_limit
+        self.window = window
+        self.db = sqlite3.connect(filename, timeout=60, isolation_level=None, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS attempts (id INTEGER PRIMARY KEY, at REAL NOT NULL, kind TEXT NOT NULL)")
+
+    def _attempts(self, now):
+        return self.db.execute(
+            "SELECT at, kind FROM attempts WHERE at > ? ORDER BY at", (now - self.window,)
+        ).fetchall()
+
+    def _free_at(self, times, limit):
+        # When enough of these tokens have come back for one more attempt
+        if len(times) < limit:
+            return 0
+        return times[len(times) - limit] + self.window
+
+    def _next_attempt(self, attempts, now):
+        successes = [at for at, kind in attempts if kind in ("success", "pending")]
+        failures = [at for at, kind in attempts if kind in ("failure", "pending")]
+        next_attempt = max(now, self._free_at(successes, self.success_limit), self._free_at(failures, self.failure_limit))
+
+        # A 53 means Steam's budget is spent even if ours isn't (other devices, a smaller limit...).
+        # It frees up an hour after the oldest attempt it counted, retrying before that only extends it.
+        # That attempt is looked up relative to the 53, it may have left the current window since.
+        if attempts and attempts[-1][1] == "limited":
+            limited_at = attempts[-1][0]
+            oldest_counted = self.db.execute(
+                "SELECT MIN(at) FROM attempts WHERE kind != 'limited' AND at > ? AND at <= ?",
+                (limited_at - self.window, limited_at),
+            ).fetchone()[0]
+            next_attempt = max(next_attempt, (oldest_counted if oldest_counted is not None else limited_at) + self.window)
+        return next_attempt
+
+    def wait_time(self):
+        now = time.time()
+        return self._next_attempt(self._attempts(now), now) - now
+
+    def acquire(self, on_wait=None):
+        # Blocks until an attempt fits in both budgets and reserves it, returns the reservation
+        while True:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                wait = self._next_attempt(self._attempts(now), now) - now
+                if wait <= 0:
+                    cursor = self.db.execute("INSERT INTO attempts (at, kind) VALUES (?, 'pending')", (now,))
+                    self.db.execute("DELETE FROM attempts WHERE at < ?", (now - 2 * self.window,))
+                    return cursor.lastrowid
+            finally:
+                self.db.execute("COMMIT")
+            if on_wait is not None:
+                on_wait(wait)
+            else:
+                time.sleep(wait)
+
+    def record(self, attempt, code):
+        kind = "success" if code == 0 else "limited" if code == 53 else "failure"
+        self.db.execute("UPDATE attempts SET kind = ? WHERE id = ?", (kind, attempt))
+
+    def release(self, attempt):
+        # The attempt never reached Steam, it doesn't count against either budget
+        self.db.execute("DELETE FROM attempts WHERE id = ?", (attempt,))
+
+    def projected_finish(self, remaining):
+        # Best case finish time for the remaining keys, assuming they all go through
+        now = time.time()
+        attempts = self._attempts(now)
+        successes = [at for at, kind in attempts if kind in ("success", "pending")]
+        start = self._next_attempt(attempts, now)
+        for i in range(remaining):
+            next_attempt = max(start, self._free_at(successes, self.success_limit))
+            successes.append(next_attempt)
+            start = next_attempt
+        return start
+
+
+@timed_phase("rate_limit_wait")
+def wait_for_steam(rate_limiter, remaining):
+    # Sleeps until the next key can go to Steam, showing when the backlog should be done
+    animation = "|/-\\"
+    seconds = 0
+
+    def on_wait(wait):
+        nonlocal seconds
+        finish = time.strftime("%H:%M", time.localtime(rate_limiter.projected_finish(remaining)))
+        minutes, secs = divmod(int(wait), 60)
+        print(
+            f"Waiting {minutes}:{secs:02d} for Steam's rate limit, {remaining} keys left, done around {finish} "
+            f"{animation[seconds % len(animation)]}",
+            end="\r",
+        )
+        time.sleep(min(1, wait))
+        seconds = seconds + 1
+
+    attempt = rate_limiter.acquire(on_wait)
+    if seconds:
+        print()
+    return attempt
+
+
+LEDGER_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS keys (
+    id INTEGER PRIMARY KEY,
+    recorded TEXT NOT NULL,
+    code INTEGER,
+    outcome TEXT NOT NULL,
+    gamekey TEXT,
+    keyindex INTEGER,
+    machine_name TEXT,
+    human_name TEXT,
+    steam_app_id INTEGER,
+    key_value TEXT
+);
+CREATE INDEX IF NOT EXISTS keys_key_value ON keys (key_value);
+CREATE INDEX IF NOT EXISTS keys_gamekey ON keys (gamekey);
+CREATE INDEX IF NOT EXISTS keys_steam_app_id ON keys (steam_app_id);
+CREATE INDEX IF NOT EXISTS keys_code ON keys (code, recorded);
+CREATE TABLE IF NOT EXISTS imported (filename TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    added TEXT NOT NULL,
+    state TEXT NOT NULL,
+    gamekey TEXT NOT NULL,
+    keyindex INTEGER,
+    human_name TEXT,
+    steam_app_id INTEGER,
+    tpk TEXT NOT NULL,
+    UNIQUE (gamekey, keyindex)
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id);
+'''
 
-    if blob["success"] == 1:
-        for item in blob["purchase_receipt_info"]["line_items"]:
-            print("Redeemed " + item["line_item_description"])
-        return 0
-    else:
-        error_code = blob.get("purchase_result_details")
-        if error_code == None:
-            # Sometimes purchase_result_details isn't there for some reason, try alt method
-            error_code = blob.get("purchase_receipt_info")
-            if error_code != None:
-                error_code = error_code.get("result_detail")
-        error_code = error_code or 53
-
-        if error_code == 14:
-            error_message = (
-                "The product code you've entered is not valid. Please double check to see if you've "
-                "mistyped your key. I, L, and 1 can look alike, as can V and Y, and 0 and O. "
-            )
-        elif error_code == 15:
-            error_message = (
-                "The product code you've entered has already been activated by a different Steam account. "
-                "This code cannot be used again. Please contact the retailer or online seller where the "
-                "code was purchased for assistance. "
-            )
-        elif error_code == 53:
-            error_message = (
-                "There have been too many recent activation attempts from this account or Internet "
-                "address. Please wait and try your product code again later. "
-            )
-        elif error_code == 13:
-            error_message = (
-                "Sorry, but this product is not available for purchase in this country. Your product key "
-                "has not been redeemed. "
-            )
-        elif error_code == 9:
-            error_message = (
-                "This Steam account already owns the product(s) contained in this offer. To access them, "
-                "visit your library in the Steam client. "
-            )
-        elif error_code == 24:
-            error_message = (
-                "The product code you've entered requires ownership of another product before "
-                "activation.\n\nIf you are trying to activate an expansion pack or downloadable content, "
-                "please first activate the original game, then activate this additional content. "
-            )
-        elif error_code == 36:
-            error_message = (
-                "The product code you have entered requires that you first play this game on the "
-                "PlayStation®3 system before it can be registered.\n\nPlease:\n\n- Start this game on "
-                "your PlayStation®3 system\n\n- Link your Steam account to your PlayStation®3 Network "
-                "account\n\n- Connect to Steam while playing this game on the PlayStation®3 system\n\n- "
-                "Register this product code through Steam. "
-            )
-        elif error_code == 50:
-            error_message = (
-                "The code you have entered is from a Steam Gift Card or Steam Wallet Code. Browse here: "
-                "https://store.steampowered.com/account/redeemwalletcode to redeem it. "
-            )
+ledger = None
+
+
+def key_outcome(code):
+    if code == 15 or code == 9:
+        return "already_owned"
+    elif code != 0:
+        return "errored"
+    return "redeemed"
+
+
+def import_csv_ledgers(db):
+    # One-time import of the CSVs older versions wrote (or a CSV view of a lost ledger),
+    # so their keys still get filtered out
+    for outcome, filename in LEDGER_CSV_FILES.items():
+        if not os.path.exists(filename) or db.execute("SELECT 1 FROM imported WHERE filename = ?", (filename,)).fetchone():
+            continue
+        rows = []
+        with open(filename, "r", encoding="utf-8-sig", newline="") as f:
+            lines = f.read().splitlines()
+        if lines and lines[0] == ",".join(LEDGER_CSV_HEADER):
+            for row in csv.DictReader(lines):
+                code = int(row["code"]) if row["code"] else None
+                rows.append((row["recorded"], code, outcome, row["gamekey"], row["human_name"], row["redeemed_key_val"]))
         else:
-            error_message = (
-                "An unexpected error has occurred.  Your product code has not been redeemed.  Please wait "
-                "30 minutes and try redeeming the code again.  If the problem persists, please contact <a "
-                'href="https://help.steampowered.com/en/wizard/HelpWithCDKey">Steam Support</a> for '
-                "further assistance. "
+            # gamekey,human_name,redeemed_key_val with commas in names swapped for periods
+            code = {"redeemed": 0, "already_owned": 9}.get(outcome)
+            for line in lines:
+                cols = line.split(",")
+                if len(cols) >= 3:
+                    rows.append(("", code, outcome, cols[0], ",".join(cols[1:-1]), cols[-1]))
+        with db:
+            db.executemany(
+                "INSERT INTO keys (recorded, code, outcome, gamekey, human_name, key_value) VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
             )
-        if error_code != 53 or not quiet:
-            print(error_message)
-        return error_code
+            db.execute("INSERT INTO imported (filename) VALUES (?)", (filename,))
+
+
+def open_ledger(filename=LEDGER_DB):
+    db = sqlite3.connect(filename)
+    db.executescript(LEDGER_SCHEMA)
+    import_csv_ledgers(db)
+    return db
 
 
-files = {}
+def get_ledger():
+    global ledger
+    if ledger is None:
+        ledger = open_ledger()
+    return ledger
+
+
+def write_keys(code, keys):
+    # All keys go in as one transaction
+    recorded = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+    rows = [
+        (
+            recorded, code, key_outcome(code), key.get("gamekey"), key.get("keyindex"), key.get("machine_name"),
+            key.get("human_name"), key.get("steam_app_id"), key.get("redeemed_key_val"),
+        )
+        for key in keys
+    ]
+    db = get_ledger()
+    with db:
+        db.executemany(
+            "INSERT INTO keys (recorded, code, outcome, gamekey, keyindex, machine_name, human_name, steam_app_id, key_value) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
 
 
 def write_key(code, key):
-    global files
+    write_keys(code, [key])
 
-    filename = "redeemed.csv"
-    if code == 15 or code == 9:
-        filename = "already_owned.csv"
-    elif code != 0:
-        filename = "errored.csv"
 
-    if filename not in files:
-        files[filename] = open(filename, "a", encoding="utf-8-sig")
-    key["human_name"] = key["human_name"].replace(",", ".")
-    gamekey = key.get('gamekey')
-    human_name = key.get("human_name")
-    redeemed_key_val = key.get("redeemed_key_val")
-    output = f"{gamekey},{human_name},{redeemed_key_val}\n"
-    files[filename].write(output)
-    files[filename].flush()
+def previous_key_values():
+    return {
+        row[0] for row in get_ledger().execute("SELECT DISTINCT key_value FROM keys WHERE key_value IS NOT NULL")
+    }
+
+
+def ledger_has_key(key_value):
+    return get_ledger().execute("SELECT 1 FROM keys WHERE key_value = ? LIMIT 1", (key_value,)).fetchone() is not None
+
+
+def query_ledger(code=None, outcome=None, since=None):
+    # e.g. query_ledger(outcome="errored", since="2024-02-26") for the keys that failed since then, times are UTC.
+    # Rate limited (53) attempts aren't recorded, those keys are retried rather than finished.
+    conditions = []
+    params = []
+    for column, value in (("code = ?", code), ("outcome = ?", outcome), ("recorded >= ?", since)):
+        if value is not None:
+            conditions.append(column)
+            params.append(value)
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+    cursor = get_ledger().execute(
+        "SELECT " + ", ".join(LEDGER_COLUMNS) + " FROM keys" + where + " ORDER BY id",
+        params,
+    )
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor]
+
+
+def print_ledger_query(selection, since=None):
+    # --query-ledger: the ledger rows for an outcome ("redeemed", "errored", ...) or a Steam result code, as CSV
+    query = query_ledger(code=int(selection), since=since) if selection.isdigit() else query_ledger(outcome=selection, since=since)
+    writer = csv.DictWriter(sys.stdout, LEDGER_COLUMNS)
+    writer.writeheader()
+    writer.writerows(query)
+
+
+def export_ledger_csv():
+    db = get_ledger()
+    for outcome, filename in LEDGER_CSV_FILES.items():
+        with open(filename, "w", encoding="utf-8-sig", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(LEDGER_CSV_HEADER)
+            for row in query_ledger(outcome=outcome):
+                writer.writerow([row["gamekey"], row["human_name"], row["key_value"], row["code"], row["recorded"]])
+        with db:
+            # It's a view of the ledger, don't import it back in
+            db.execute("INSERT OR IGNORE INTO imported (filename) VALUES (?)", (filename,))
+        print(f"Exported {filename}")
 
 
 def prompt_skipped(skipped_games):
@@ -558,49 +1703,387 @@ def prompt_yes_no(question):
         else:
             return True if ans == "y" else False
 
-def get_owned_apps(steam_session):
+app_list_refresh = False
+order_cache_refresh = False
+
+
+APP_LIST_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS apps (appid INTEGER PRIMARY KEY, name TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS info (name TEXT PRIMARY KEY, value REAL);
+'''
+
+
+def open_app_list_cache(cache_file=STEAM_APP_LIST_CACHE):
+    db = sqlite3.connect(cache_file)
+    try:
+        db.executescript(APP_LIST_SCHEMA)
+    except sqlite3.DatabaseError:
+        # Unreadable, start over with an empty one
+        db.close()
+        os.remove(cache_file)
+        db = sqlite3.connect(cache_file)
+        db.executescript(APP_LIST_SCHEMA)
+    return db
+
+
+def app_list_downloaded(db):
+    row = db.execute("SELECT value FROM info WHERE name = 'downloaded'").fetchone()
+    return row[0] if row is not None else None
+
+
+def store_app_list(db, apps, downloaded=None):
+    # apps is (appid, name) pairs, stored as they're read. Apps already in the cache stay, Steam drops delisted ones.
+    with db:
+        db.executemany("INSERT OR REPLACE INTO apps (appid, name) VALUES (?, ?)", apps)
+        db.execute(
+            "INSERT OR REPLACE INTO info (name, value) VALUES ('downloaded', ?)",
+            (time.time() if downloaded is None else downloaded,),
+        )
+
+
+def lookup_app_names(db, app_ids):
+    app_ids = list(app_ids)
+    names = {}
+    for start in range(0, len(app_ids), APP_LIST_LOOKUP_BATCH):
+        batch = app_ids[start:start + APP_LIST_LOOKUP_BATCH]
+        names.update(db.execute(
+            f"SELECT appid, name FROM apps WHERE appid IN ({','.join('?' * len(batch))})", batch
+        ))
+    return names
+
+
+def seed_app_list_cache(seed_file, cache_file=STEAM_APP_LIST_CACHE):
+    # Accepts a saved STEAM_APP_LIST_API response, or {"apps": [[appid, name], ...]} with an optional "timestamp".
+    # Returns how many apps the cache holds.
+    with open(seed_file, "r", encoding="utf-8") as f:
+        seed = json.load(f)
+    if "applist" in seed:
+        apps = ((app["appid"], app["name"]) for app in seed["applist"]["apps"])
+    else:
+        apps = ((appid, name) for appid, name in seed["apps"])
+    db = open_app_list_cache(cache_file)
+    try:
+        store_app_list(db, apps, seed.get("timestamp"))
+        return db.execute("SELECT COUNT(*) FROM apps").fetchone()[0]
+    finally:
+        db.close()
+
+
+APP_LIST_SEPARATOR = re.compile(r"[\s,]*")
+
+
+def iter_app_list(chunks):
+    # Yields (appid, name) from a STEAM_APP_LIST_API body as it streams in, one app at a time,
+    # so the whole catalog never has to be in memory. Expects {"applist":{"apps":[{...},...]}}.
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    in_apps = False
+    for chunk in chunks:
+        buffer += text.decode(chunk)
+        if not in_apps:
+            start = buffer.find('"apps"')
+            bracket = buffer.find("[", start) if start != -1 else -1
+            if bracket == -1:
+                continue
+            buffer = buffer[bracket + 1:]
+            in_apps = True
+        position = 0
+        while True:
+            position = APP_LIST_SEPARATOR.match(buffer, position).end()
+            if position == len(buffer):
+                break
+            if buffer[position] == "]":
+                return
+            try:
+                app, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                # Rest of this app is in the next chunk
+                break
+            yield app["appid"], app["name"]
+            position = end
+        buffer = buffer[position:]
+    raise ValueError("The Steam app list ended early")
+
+
+def download_app_list(steam_session, db):
+    # Streams the catalog straight into the cache, it's never all in memory
+    r = steam_session.get(STEAM_APP_LIST_API, stream=True, timeout=60)
+    try:
+        r.raise_for_status()
+        store_app_list(db, iter_app_list(r.iter_content(STEAM_APP_LIST_CHUNK)))
+    finally:
+        r.close()
+
+
+def get_app_list(steam_session, required_app_ids=(), max_age=APP_LIST_MAX_AGE, force_refresh=False, cache_file=STEAM_APP_LIST_CACHE, progress=True):
+    # Returns {appid: name} for the required apps the catalog lists, only downloading it when the cache is too old.
+    # Apps newer than the cache are left out until the next download, exact AppID checks don't need their names.
+    db = open_app_list_cache(cache_file)
+    try:
+        downloaded = app_list_downloaded(db)
+        if force_refresh or downloaded is None or time.time() - downloaded > max_age:
+            if progress:
+                if downloaded is None:
+                    print("Downloading the Steam app list, this may take a moment...")
+                else:
+                    print("Updating the cached Steam app list...")
+            download_app_list(steam_session, db)
+        return lookup_app_names(db, required_app_ids)
+    finally:
+        db.close()
+
+
+def load_package_cache(cache_file=STEAM_PACKAGE_CACHE):
+    try:
+        with open(cache_file, "r", encoding="utf-8") as f:
+            return {int(package_id): apps for package_id, apps in json.load(f).items()}
+    except (OSError, ValueError, AttributeError):
+        return {}
+
+
+def save_package_cache(cache, cache_file=STEAM_PACKAGE_CACHE):
+    write_json_atomic(cache_file, {str(package_id): apps for package_id, apps in cache.items()})
+
+
+def seed_package_cache(seed_file, cache_file=STEAM_PACKAGE_CACHE):
+    # Accepts {package_id: [appid, ...]}, a previous cache file ({package_id: [[appid, name], ...]})
+    # or saved STEAM_PACKAGE_DETAILS_API responses merged into one object
+    with open(seed_file, "r", encoding="utf-8") as f:
+        seed = json.load(f)
+    cache = load_package_cache(cache_file)
+    for package_id, apps in seed.items():
+        if isinstance(apps, dict):
+            apps = [[app["id"], app["name"]] for app in apps["data"]["apps"]] if apps.get("success") else []
+        cache[int(package_id)] = [app if isinstance(app, list) else [app, None] for app in apps]
+    save_package_cache(cache, cache_file)
+    return cache
+
+
+def download_package_apps(steam_session, package_id):
+    details = steam_session.get(STEAM_PACKAGE_DETAILS_API, params={"packageids": package_id}, timeout=30).json()
+    details = details[str(package_id)]
+    if not details.get("success"):
+        # Packages Steam won't describe (retired, region locked...) are remembered as empty
+        return []
+    return [[app["id"], app["name"]] for app in details["data"]["apps"]]
+
+
+def get_package_apps(steam_session, package_ids, lookups=STEAM_PACKAGE_LOOKUPS, cache_file=STEAM_PACKAGE_CACHE, progress=True):
+    # Returns {package_id: [[appid, name], ...]}, looking up packages the cache doesn't know yet
+    cache = load_package_cache(cache_file)
+    missing = [package_id for package_id in package_ids if package_id not in cache]
+    if missing:
+        if progress:
+            print(f"Looking up the contents of {min(len(missing), lookups)} Steam packages...")
+        with ThreadPoolExecutor(max_workers=STEAM_PACKAGE_WORKERS) as executor:
+            futures = {
+                executor.submit(download_package_apps, steam_session, package_id): package_id
+                for package_id in missing[:lookups]
+            }
+            for future in as_completed(futures):
+                try:
+                    cache[futures[future]] = future.result()
+                except (requests.RequestException, ValueError, KeyError, TypeError, AttributeError) as e:
+                    # Not cached, so it's looked up again next run
+                    print(f"Couldn't look up Steam package {futures[future]}: {e}", file=sys.stderr)
+        save_package_cache(cache, cache_file)
+        if progress and len(missing) > lookups:
+            print(f"{len(missing) - lookups} more packages will be looked up on later runs")
+    return {package_id: cache[package_id] for package_id in package_ids if package_id in cache}
+
+
+@timed_phase("ownership_load")
+def get_owned_apps(steam_session, progress=True):
+    global app_list_refresh
+
     owned_content = steam_session.get(STEAM_USERDATA_API).json()
-    owned_app_ids = owned_content["rgOwnedPackages"] + owned_content["rgOwnedApps"]
-    owned_app_details = {
-        app["appid"]: app["name"]
-        for app in steam_session.get(STEAM_APP_LIST_API).json()["applist"]["apps"]
-        if app["appid"] in owned_app_ids
-    }
+    # Package IDs are their own numbering, they only tell us about apps through what the packages contain
+    package_apps = get_package_apps(steam_session, owned_content["rgOwnedPackages"], progress=progress)
+    owned_app_ids = set(owned_content["rgOwnedApps"])
+    for apps in package_apps.values():
+        owned_app_ids.update(appid for appid, name in apps)
+
+    app_list = get_app_list(steam_session, owned_app_ids, force_refresh=app_list_refresh, progress=progress)
+    app_list_refresh = False # Only force it once per run
+    # Apps the cached catalog doesn't list yet still count for exact AppID checks
+    owned_app_details = {appid: app_list.get(appid, "") for appid in sorted(owned_app_ids)}
+    # Packages name some apps the catalog doesn't
+    for apps in package_apps.values():
+        for appid, name in apps:
+            if name and not owned_app_details[appid]:
+                owned_app_details[appid] = name
     return owned_app_details
 
-def match_ownership(owned_app_details, game, filter_live):
-    threshold = 70
-    best_match = (0, None)
-    # Do a string search based on product names.
+MATCH_THRESHOLD = 70
+MATCH_CUTOFF = 35
+
+
+def name_tokens(name):
+    # Same normalization fuzz.token_set_ratio applies before comparing
+    return set(utils.full_process(name, force_ascii=True).split())
+
+
+def normalized_title(name):
+    # Titles with the same normalized form always get the same match_ownership result
+    return " ".join(sorted(utils.full_process(name, force_ascii=True).split()))
+
+
+def dedupe_keys(keys, seen_app_ids=None, seen_titles=None):
+    # Splits keys into the first key for each game and repeats of it, in order. A repeat shares a
+    # Steam AppID or normalized title with an earlier key and would only cost a failed activation.
+    seen_app_ids = set() if seen_app_ids is None else seen_app_ids
+    seen_titles = set() if seen_titles is None else seen_titles
+    unique = []
+    duplicates = []
+    for key in keys:
+        # Titles with nothing left after normalizing (non-latin names) are compared as they are
+        title = normalized_title(key["human_name"]) or key["human_name"].strip()
+        app_id = key.get("steam_app_id")
+        if title in seen_titles or (app_id is not None and app_id in seen_app_ids):
+            duplicates.append(key)
+            continue
+        seen_titles.add(title)
+        if app_id is not None:
+            seen_app_ids.add(app_id)
+        unique.append(key)
+    return unique, duplicates
+
+
+def build_ownership_index(owned_app_details):
+    # Inverted index over owned app names, built once per run and passed to match_ownership
+    index = {"position": {}, "tokens": {}, "sorted_names": {}, "by_length": {}}
+    for position, (appid, appname) in enumerate(owned_app_details.items()):
+        tokens = name_tokens(appname)
+        if not tokens:
+            # token_set_ratio scores these 0 against anything
+            continue
+        sorted_name = " ".join(sorted(tokens))
+        index["position"][appid] = position
+        index["sorted_names"][appid] = sorted_name
+        index["by_length"].setdefault(len(sorted_name), []).append(appid)
+        for token in tokens:
+            index["tokens"].setdefault(token, []).append(appid)
+    return index
+
+
+def indexed_matches(owned_app_details, index, human_name, threshold):
+    # Returns the same (score, appid) pairs above threshold as scoring every owned app, in the same order
+    tokens = name_tokens(human_name)
+    if not tokens:
+        return []
+    sorted_name = " ".join(sorted(tokens))
+
+    candidates = set()
+    for token in tokens:
+        candidates.update(index["tokens"].get(token, ()))
     matches = [
-        (fuzz.token_set_ratio(appname, game["human_name"]), appid)
-        for appid, appname in owned_app_details.items()
+        (fuzz.token_set_ratio(owned_app_details[appid], human_name), appid)
+        for appid in candidates
     ]
+
+    # With no tokens in common token_set_ratio is just fuzz.ratio of the sorted names,
+    # which can't beat 200*shorter/(both lengths), so only check lengths that could pass
+    length = len(sorted_name)
+    for app_length, appids in index["by_length"].items():
+        if 200 * min(length, app_length) <= threshold * (length + app_length):
+            continue
+        matches.extend(
+            (fuzz.ratio(index["sorted_names"][appid], sorted_name), appid)
+            for appid in appids
+            if appid not in candidates
+        )
+
+    matches = [match for match in matches if match[0] > threshold]
+    matches.sort(key=lambda match: index["position"][match[1]])
+    return matches
+
+
+def load_match_decisions(owned_app_details, cache_file=MATCH_DECISION_CACHE):
+    try:
+        with open(cache_file, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+        previous = {appid: name for appid, name in cache["owned"]}
+        entries = cache["entries"]
+    except (OSError, ValueError, KeyError, TypeError):
+        previous = {}
+        entries = {}
+
+    # A decision only depends on the owned apps that passed the first threshold for it,
+    # so only evict entries that lost one of those or that a new/renamed app could now match
+    removed = {appid for appid, name in previous.items() if owned_app_details.get(appid) != name}
+    added = {appid: name for appid, name in owned_app_details.items() if previous.get(appid) != name}
+    if entries and (removed or added):
+        added_index = build_ownership_index(added)
+        for title in list(entries):
+            if (
+                not removed.isdisjoint(entries[title]["candidates"])
+                or indexed_matches(added, added_index, title, MATCH_THRESHOLD)
+            ):
+                del entries[title]
+
+    return {"file": cache_file, "owned": dict(owned_app_details), "entries": entries}
+
+
+def save_match_decisions(decisions):
+    write_json_atomic(decisions["file"], {
+        "owned": [[appid, name] for appid, name in decisions["owned"].items()],
+        "entries": decisions["entries"],
+    })
+
+
+@timed_phase("matching")
+def match_ownership(owned_app_details, game, filter_live, index=None, decisions=None):
+    threshold = MATCH_THRESHOLD
+    best_match = (0, None)
+    mode = "live" if filter_live else "auto"
+    if decisions is not None:
+        title = normalized_title(game["human_name"])
+        entry = decisions["entries"].get(title, {})
+        if mode in entry:
+            return tuple(entry[mode])
+
+    # Do a string search based on product names.
+    if index is None:
+        matches = [
+            (fuzz.token_set_ratio(appname, game["human_name"]), appid)
+            for appid, appname in owned_app_details.items()
+        ]
+    else:
+        matches = indexed_matches(owned_app_details, index, game["human_name"], threshold)
     refined_matches = [
         (fuzz.token_sort_ratio(owned_app_details[appid], game["human_name"]), appid)
         for score, appid in matches
         if score > threshold
     ]
     
+    asked = False
     if filter_live and len(refined_matches) > 0:
         cls()
         best_match = max(refined_matches, key=lambda item: item[0])
-        if best_match[0] == 100:
-            return best_match
-        print("steam games you own")
-        for match in refined_matches:
-            print(f"     {owned_app_details[match[1]]}: {match[0]}")
-        if prompt_yes_no(f"Is \"{game['human_name']}\" in the above list?"):
-            return refined_matches[0]
-        else:
-            return (0,None)
+        if best_match[0] != 100:
+            print("steam games you own")
+            for match in refined_matches:
+                print(f"     {owned_app_details[match[1]]}: {match[0]}")
+            if prompt_yes_no(f"Is \"{game['human_name']}\" in the above list?"):
+                best_match = refined_matches[0]
+            else:
+                best_match = (0,None)
+            asked = True
     else:
         if len(refined_matches) > 0:
             best_match = max(refined_matches, key=lambda item: item[0])
         elif len(refined_matches) == 1:
             best_match = refined_matches[0]
-        if best_match[0] < 35:
+        if best_match[0] < MATCH_CUTOFF:
             best_match = (0,None)
+
+    if decisions is not None:
+        entry = decisions["entries"].setdefault(title, {"candidates": [appid for score, appid in refined_matches]})
+        entry[mode] = list(best_match)
+        if asked:
+            # Don't lose the user's answers if the run gets interrupted
+            save_match_decisions(decisions)
     return best_match
 
 def prompt_filter_live():
@@ -613,30 +2096,38 @@ def prompt_filter_live():
             print("Enter y or n")
     return mode
 
-def redeem_steam_keys(humble_session, humble_keys):
-    session = steam_login()
+def redeem_steam_keys(humble_session, humble_keys, steam_preload=None):
+    # Repeats of the same game are dealt with before anything goes over the network
+    humble_keys, duplicates = dedupe_keys(humble_keys)
+    if duplicates:
+        write_keys(9, duplicates)
+        print(f"Skipping {len(duplicates)} keys for games that appear more than once")
 
-    print("Successfully signed in on Steam.")
-    print("Getting your owned content to avoid attempting to register keys already owned...")
+    # Asked up front, Steam may still be loading in the background
+    filter_live = prompt_filter_live() == "y"
 
+    if steam_preload is None or not steam_preload.done():
+        print("Getting your owned content to avoid attempting to register keys already owned...")
     # Query owned App IDs according to Steam
-    owned_app_details = get_owned_apps(session)
+    session, owned_app_details = steam_ownership(steam_preload)
+    print("Successfully signed in on Steam.")
 
     noted_keys = [key for key in humble_keys if key["steam_app_id"] not in owned_app_details.keys()]
+    ownership_index = build_ownership_index(owned_app_details)
+    match_decisions = load_match_decisions(owned_app_details)
     skipped_games = {}
     unownedgames = []
 
     # Some Steam keys come back with no Steam AppID from Humble
     # So we do our best to look up from AppIDs (no packages, because can't find an API for it)
 
-    filter_live = prompt_filter_live() == "y"
-
     for game in noted_keys:
-        best_match = match_ownership(owned_app_details,game,filter_live)
+        best_match = match_ownership(owned_app_details,game,filter_live,ownership_index,match_decisions)
         if best_match[1] is not None and best_match[1] in owned_app_details.keys():
             skipped_games[game["human_name"].strip()] = game
         else:
             unownedgames.append(game)
+    save_match_decisions(match_decisions)
 
     print(
         "Filtered out game keys that you already own on Steam; {} keys unowned.".format(
@@ -648,59 +2139,272 @@ def redeem_steam_keys(humble_session, humble_keys):
         # Skipped games uncertain to be owned by user. Let user choose
         unownedgames = unownedgames + prompt_skipped(skipped_games)
         print("{} keys will be attempted.".format(len(unownedgames)))
-        # Preserve original order
-        unownedgames = sorted(unownedgames,key=lambda g: humble_keys.index(g))
-    
-    redeemed = []
 
-    for key in unownedgames:
+    # Preserve original order
+    attempted = {(key["gamekey"], key["keyindex"]) for key in unownedgames}
+    to_redeem = [key for key in humble_keys if (key["gamekey"], key["keyindex"]) in attempted]
+
+    rate_limiter = SteamRateLimiter()
+
+    for remaining, key in zip(range(len(to_redeem), 0, -1), reveal_ahead(humble_session, to_redeem)):
         print(key["human_name"])
+        redeem_on_steam(session, rate_limiter, key, remaining)
+
+
+def redeem_on_steam(session, rate_limiter, key, remaining):
+    # Redeems an already revealed key, waiting out the rate limit, and records the result
+    if not valid_steam_key(key["redeemed_key_val"]):
+        # Most likely humble gift link
+        write_key(1, key)
+        return 1
+
+    """NOTE
+    Steam seems to limit to about 50 keys/hr -- even if all 50 keys are legitimate *sigh*
+    Even worse: 10 *failed* keys/hr
+    Duplication counts towards Steam's _failure rate limit_,
+    hence why we've worked so hard above to figure out what we already own
+    """
+    code = None
+    quiet = False
+    while code is None or code == 53:
+        attempt = wait_for_steam(rate_limiter, remaining)
+        code = None
+        unavailable = None
+        try:
+            code = _redeem_steam(session, key["redeemed_key_val"], quiet=quiet).code
+        except SteamUnavailable as e:
+            unavailable = e
+        finally:
+            # Never left pending. Without an answer the key may still have reached Steam, so that's a failed attempt.
+            if unavailable is not None and not unavailable.sent:
+                rate_limiter.release(attempt)
+            else:
+                rate_limiter.record(attempt, code)
+        if code is None:
+            print(unavailable)
+            time.sleep(max(0, unavailable.retry_at - time.time()))
+        quiet = True
+
+    write_key(code, key)
+    return code
+
+
+DAEMON_DEFAULTS = {
+    # Reveal unrevealed Steam keys on Humble (removes the ability to gift them)
+    "reveal_unrevealed": False,
+    # Redeem keys that are already revealed on Humble
+    "include_revealed": True,
+    # Try keys we think are owned but aren't sure of, instead of leaving them be
+    "attempt_uncertain": False,
+    # How often to look for newly purchased keys, in seconds
+    "poll_interval": 60 * 60,
+}
 
-        if key["human_name"] in redeemed or (key["steam_app_id"] != None and key["steam_app_id"] in redeemed):
-            # We've bumped into a repeat of the same game!
-            write_key(9,key)
+
+def load_daemon_config(config_file):
+    config = dict(DAEMON_DEFAULTS)
+    with open(config_file, "r", encoding="utf-8") as f:
+        config.update(json.load(f))
+    unknown = set(config) - set(DAEMON_DEFAULTS)
+    if unknown:
+        raise ValueError(f"Unknown daemon settings in {config_file}: {', '.join(sorted(unknown))}")
+    return config
+
+
+def queue_new_keys(humble_session, steam_session, config):
+    # Adds Steam keys we haven't dealt with yet to the job queue, returns how many were added
+    db = get_ledger()
+    order_details, key_index = get_humble_keys(humble_session)
+    queued = set()
+    seen_app_ids = set()
+    seen_titles = set()
+    for gamekey, keyindex, human_name, steam_app_id in db.execute("SELECT gamekey, keyindex, human_name, steam_app_id FROM jobs"):
+        queued.add((gamekey, keyindex))
+        seen_titles.add(normalized_title(human_name) or human_name.strip())
+        if steam_app_id is not None:
+            seen_app_ids.add(steam_app_id)
+
+    previous_keys = previous_key_values()
+    keys = [
+        key for key in indexed_keys(key_index, "steam_app_id")
+        if (key["gamekey"], key["keyindex"]) not in queued
+        and key.get("redeemed_key_val", False) not in previous_keys
+        and (config["include_revealed"] if "redeemed_key_val" in key else config["reveal_unrevealed"])
+    ]
+    if not keys:
+        return 0
+
+    owned_app_details = get_owned_apps(steam_session)
+    ownership_index = build_ownership_index(owned_app_details)
+    match_decisions = load_match_decisions(owned_app_details)
+    unowned = []
+    for key in keys:
+        if key["steam_app_id"] in owned_app_details.keys():
+            continue
+        best_match = match_ownership(owned_app_details, key, False, ownership_index, match_decisions)
+        if best_match[1] is not None and best_match[1] in owned_app_details.keys() and not config["attempt_uncertain"]:
+            continue
+        unowned.append(key)
+    save_match_decisions(match_decisions)
+
+    unique, duplicates = dedupe_keys(unowned, seen_app_ids, seen_titles)
+    jobs = [("pending", key) for key in unique] + [("duplicate", key) for key in duplicates]
+
+    write_keys(9, duplicates)
+    added = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+    with db:
+        db.executemany(
+            "INSERT INTO jobs (added, state, gamekey, keyindex, human_name, steam_app_id, tpk) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (added, state, key["gamekey"], key["keyindex"], key["human_name"], key["steam_app_id"], json.dumps(key.to_dict()))
+                for state, key in jobs
+            ],
+        )
+    return len(unique)
+
+
+def daemon_mode(config_file):
+    # Unattended Auto-Redeem: works through a queue of key jobs stored next to the ledger, so a
+    # restart carries on from the job it stopped on, and checks Humble for new keys every poll_interval
+    config = load_daemon_config(config_file)
+    humble_session = get_humble_session(interactive=False)
+    steam_session = steam_login(interactive=False)
+    rate_limiter = SteamRateLimiter()
+    db = get_ledger()
+    process_quit(lambda: print("Stopping, pending keys will be picked up on the next start."))
+
+    next_poll = 0
+    while True:
+        if time.time() >= next_poll:
+            added = queue_new_keys(humble_session, steam_session, config)
+            next_poll = time.time() + config["poll_interval"]
+            if added:
+                print(f"Queued {added} new keys")
+
+        pending = db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'pending'").fetchone()[0]
+        job = db.execute("SELECT id, tpk FROM jobs WHERE state = 'pending' ORDER BY id LIMIT 1").fetchone()
+        if job is None:
+            time.sleep(max(0, next_poll - time.time()))
             continue
-        else:
-            if key["steam_app_id"] != None:
-                redeemed.append(key["steam_app_id"])
-            redeemed.append(key["human_name"])
 
+        job_id, key = job[0], KeyRecord(json.loads(job[1]))
+        print(key["human_name"])
         if "redeemed_key_val" not in key:
-            # This key is unredeemed via Humble, trigger redemption process.
-            redeemed_key = redeem_humble_key(humble_session, key)
-            key["redeemed_key_val"] = redeemed_key
-            # Worth noting this will only persist for this loop -- does not get saved to unownedgames' obj
-
-        if not valid_steam_key(key["redeemed_key_val"]):
-            # Most likely humble gift link
-            write_key(1, key)
-            continue
+            key["redeemed_key_val"] = redeem_humble_key(humble_session, key)
+            with db:
+                # Don't reveal it again if we get stopped before Steam is done with it
+                db.execute("UPDATE jobs SET tpk = ? WHERE id = ?", (json.dumps(key.to_dict()), job_id))
+
+        if not (key["redeemed_key_val"] and ledger_has_key(key["redeemed_key_val"])):
+            # Otherwise it was finished last time, we were stopped before the job was marked done
+            redeem_on_steam(steam_session, rate_limiter, key, pending)
+        with db:
+            db.execute("UPDATE jobs SET state = 'done' WHERE id = ?", (job_id,))
+        save_metrics()
+
+
+class CsvExportWriter:
+    def __init__(self, filename, columns):
+        self.columns = columns
+        self.file = open(filename, 'w', encoding="utf-8-sig", newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(columns)
+
+    def write(self, row):
+        self.writer.writerow(["" if row[col] is None else row[col] for col in self.columns])
+
+    def close(self):
+        self.file.close()
+
+
+class JsonLinesExportWriter:
+    def __init__(self, filename, columns):
+        self.columns = columns
+        self.file = open(filename, 'w', encoding="utf-8")
+
+    def write(self, row):
+        self.file.write(json.dumps({col: row[col] for col in self.columns}) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+class ArrowExportWriter:
+    # Parquet or Arrow IPC, written a batch of rows at a time. Needs pyarrow.
+    batch_size = 5000
+
+    def __init__(self, filename, columns, parquet):
+        # prompt_export_format has made sure pyarrow is there
+        import pyarrow
+        import pyarrow.parquet
+        self.pa = pyarrow
+        self.columns = columns
+        self.schema = pyarrow.schema([
+            (col, pyarrow.bool_() if col in EXPORT_BOOL_COLUMNS else pyarrow.string()) for col in columns
+        ])
+        if parquet:
+            self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema)
+        else:
+            self.writer = pyarrow.ipc.new_file(filename, self.schema)
+        self.rows = []
+
+    def write(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.writer.write_batch(self.pa.RecordBatch.from_pylist(self.rows, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+EXPORT_BOOL_COLUMNS = ['is_gift','is_expired','steam_ownership']
+EXPORT_FORMATS = {
+    "csv": ("csv", CsvExportWriter),
+    "jsonl": ("jsonl", JsonLinesExportWriter),
+    "parquet": ("parquet", lambda filename, columns: ArrowExportWriter(filename, columns, True)),
+    "arrow": ("arrow", lambda filename, columns: ArrowExportWriter(filename, columns, False)),
+}
 
-        code = _redeem_steam(session, key["redeemed_key_val"])
-        animation = "|/-\\"
-        seconds = 0
-        while code == 53:
-            """NOTE
-            Steam seems to limit to about 50 keys/hr -- even if all 50 keys are legitimate *sigh*
-            Even worse: 10 *failed* keys/hr
-            Duplication counts towards Steam's _failure rate limit_,
-            hence why we've worked so hard above to figure out what we already own
-            """
-            current_animation = animation[seconds % len(animation)]
-            print(
-                f"Waiting for rate limit to go away (takes an hour after first key insert) {current_animation}",
-                end="\r",
-            )
-            time.sleep(1)
-            seconds = seconds + 1
-            if seconds % 60 == 0:
-                # Try again every 60 seconds
-                code = _redeem_steam(session, key["redeemed_key_val"], quiet=True)
 
-        write_key(code, key)
+def arrow_available():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        return False
+    return True
+
+
+def export_row(tpk, columns):
+    row = {}
+    for col in columns:
+        value = tpk.get(col)
+        if value is not None:
+            value = bool(value) if col in EXPORT_BOOL_COLUMNS else str(value)
+        row[col] = value
+    return row
+
+
+def prompt_export_format():
+    export_format = None
+    while export_format not in EXPORT_FORMATS:
+        export_format = input(f"Export format? [{'/'.join(EXPORT_FORMATS)}] ").strip().lower()
+        if export_format not in EXPORT_FORMATS:
+            print(f"{export_format} is not a valid format")
+        elif export_format in ("parquet", "arrow") and not arrow_available():
+            # Asked before anything gets revealed, a missing pyarrow can't cost any gift links
+            print("Exporting to Parquet or Arrow needs pyarrow, install it with: pip install pyarrow")
+            export_format = None
+    return export_format
 
 
-def export_mode(humble_session,order_details):
+def export_mode(humble_session,order_details,key_index=None,steam_preload=None):
     cls()
 
     export_key_headers = ['human_name','redeemed_key_val','is_gift','key_type_human_name','is_expired','steam_ownership']
@@ -726,74 +2430,129 @@ def export_mode(humble_session,order_details):
             extra = "Steam " if export_steam_only else ""
             confirm_reveal = prompt_yes_no(f"Please CONFIRM that you would like ALL {extra}keys on Humble to be revealed, this can't be undone.")
     steam_config = prompt_yes_no("Would you like to sign into Steam to detect ownership on the export data?")
+    export_format = prompt_export_format()
     
     if(steam_config):
-        steam_session = steam_login()
-        if(verify_logins_session(steam_session)[1]):
-            owned_app_details = get_owned_apps(steam_session)
+        steam_session, owned_app_details = steam_ownership(steam_preload)
+        if(owned_app_details != None):
+            ownership_index = build_ownership_index(owned_app_details)
+            match_decisions = load_match_decisions(owned_app_details)
     
     desired_keys = "steam_app_id" if export_steam_only else "key_type_human_name"
-    keylist = list(find_dict_keys(order_details,desired_keys,True))
+    if key_index is None:
+        key_index = build_key_index(order_details)
+    keylist = indexed_keys(key_index,desired_keys)
 
+    # Keys an interrupted export revealed were unrevealed when it started, so a rerun exports them again
+    checkpoint = load_reveal_checkpoint()
+    unrevealed = lambda tpk: "redeemed_key_val" not in tpk or (tpk["gamekey"], tpk["keyindex"]) in checkpoint
     for idx,tpk in enumerate(keylist):
-        revealed = "redeemed_key_val" in tpk
+        revealed = not unrevealed(tpk)
         export = (export_revealed and revealed) or (export_unrevealed and not revealed)
-
         if(export):
-            if(export_unrevealed and confirm_reveal):
-                # Redeem key if user requests all keys to be revealed
-                tpk["redeemed_key_val"] = redeem_humble_key(humble_session,tpk)
-            
+            keys.append(tpk)
+
+    if(export_unrevealed and confirm_reveal):
+        # Redeem keys if user requests all keys to be revealed
+        bulk_reveal(humble_session,[tpk for tpk in keys if unrevealed(tpk)])
+
+    ts = time.strftime("%Y%m%d-%H%M%S")
+    extension, export_writer = EXPORT_FORMATS[export_format]
+    filename = f"humble_export_{ts}.{extension}"
+    writer = export_writer(filename, export_key_headers)
+    try:
+        # Rows go out as they're worked out rather than being collected first
+        for tpk in keys:
+            row = export_row(tpk, export_key_headers)
             if(owned_app_details != None and "steam_app_id" in tpk):
                 # User requested Steam Ownership info
                 owned = tpk["steam_app_id"] in owned_app_details.keys()
                 if(not owned):
                     # Do a search to see if user owns it
-                    best_match = match_ownership(owned_app_details,tpk,False)
+                    best_match = match_ownership(owned_app_details,tpk,False,ownership_index,match_decisions)
                     owned = best_match[1] is not None and best_match[1] in owned_app_details.keys()
-                tpk["steam_ownership"] = owned
-            
-            keys.append(tpk)
-    
-    ts = time.strftime("%Y%m%d-%H%M%S")
-    filename = f"humble_export_{ts}.csv"
-    with open(filename, 'w', encoding="utf-8-sig") as f:
-        f.write(','.join(export_key_headers)+"\n")
-        for key in keys:
-            row = []
-            for col in export_key_headers:
-                if col in key:
-                    row.append("\"" + str(key[col]) + "\"")
-                else:
-                    row.append("")
-            f.write(','.join(row)+"\n")
-    
+                row["steam_ownership"] = owned
+            writer.write(row)
+    finally:
+        writer.close()
+
+    if owned_app_details != None:
+        save_match_decisions(match_decisions)
+
+    if os.path.exists(HUMBLE_REVEAL_CHECKPOINT):
+        # Everything revealed made it into the export
+        os.remove(HUMBLE_REVEAL_CHECKPOINT)
     print(f"Exported to {filename}")
 
 
-def choose_games(humble_session,choice_month_name,identifier,chosen):
+def choose_content(humble_session,gamekey,identifier,display_names):
+    payload = {
+        "gamekey":gamekey,
+        "parent_identifier":identifier,
+        "chosen_identifiers[]":display_names,
+        "is_multikey_and_from_choice_modal":"false"
+    }
+    status,res = perform_post(humble_session,HUMBLE_CHOOSE_CONTENT,payload)
+    return status == 200 and res.get("success",False), res
+
+
+def choose_games(humble_session,identifier,chosen):
+    # Chooses a month's games in one request, or one at a time if Humble won't take them together.
+    # Returns the chosen games and (game, response) for the ones that failed.
+    if not chosen:
+        return [], []
+    gamekey = chosen[0]["tpkds"][0]["gamekey"]
+    success,res = choose_content(humble_session,gamekey,identifier,[choice["display_item_machine_name"] for choice in chosen])
+    if success:
+        return chosen, []
+    if len(chosen) == 1:
+        return [], [(chosen[0], res)]
+
+    made = []
+    failed = []
     for choice in chosen:
-        display_name = choice["display_item_machine_name"]
-        if "tpkds" not in choice:
-            webbrowser.open(f"{HUMBLE_SUB_PAGE}{choice_month_name}/{display_name}")
+        success,res = choose_content(humble_session,gamekey,identifier,[choice["display_item_machine_name"]])
+        if success:
+            made.append(choice)
         else:
-            payload = {
-                "gamekey":choice["tpkds"][0]["gamekey"],
-                "parent_identifier":identifier,
-                "chosen_identifiers[]":display_name,
-                "is_multikey_and_from_choice_modal":"false"
-            }
-            status,res = perform_post(driver,HUMBLE_CHOOSE_CONTENT,payload)
-            if not ("success" in res or not res["success"]):
-                print("Error choosing " + choice["title"])
-                print(res)
-            else:
-                print("Chose game " + choice["title"])
+            failed.append((choice, res))
+    return made, failed
 
 
-def humble_chooser_mode(humble_session,order_details):
+def chosen_steam_keys(humble_session,gamekey,chosen):
+    # The month's order only, for the keyindex Humble gave each chosen game's keys
+    order = slim_order(humble_get_json(humble_session, f"{HUMBLE_ORDER_DETAILS_API}{gamekey}?all_tpkds=true"))
+    machine_names = set(tpk["machine_name"] for choice in chosen for tpk in choice["tpkds"])
+    return [
+        key for key in indexed_keys(build_key_index([order]),"steam_app_id")
+        if key["machine_name"] in machine_names
+    ]
+
+
+def choose_month(humble_session,month,chosen,get_keys):
+    # Runs in the background while the next month is on screen.
+    # Returns the chosen games, the failures and, if get_keys, the chosen games' Steam keys.
+    # The keys are None if they couldn't be worked out here and the month's order needs fetching again.
+    try:
+        made, failed = choose_games(humble_session,month["parent_identifier"],chosen)
+    except requests.RequestException as e:
+        # Humble may or may not have taken the choices before the connection failed
+        failed = [(choice, {"success": False, "error_msg": str(e)}) for choice in chosen]
+        return [], failed, None if get_keys else []
+    keys = []
+    if get_keys and made:
+        try:
+            keys = chosen_steam_keys(humble_session,month["gamekey"],made)
+        except (requests.RequestException, ValueError):
+            keys = None
+    return made, failed, keys
+
+
+def humble_chooser_mode(humble_session,order_details,key_index=None,steam_preload=None):
     try_redeem_keys = []
-    months = get_choices(humble_session,order_details)
+    # Months being chosen in the background
+    choosing = []
+    months = get_choices(humble_session,order_details,key_index)
     count = 0
     first = True
     for month in months:
@@ -849,7 +2608,9 @@ def humble_chooser_mode(humble_session,order_details):
                 ready = True
             elif(user_input[0].lower() == 'link'):
                 webbrowser.open(HUMBLE_SUB_PAGE + month["product"]["choice_url"])
-                if redeem_keys:
+                # Choices may get made on the webpage
+                forget_month_data(month["product"]["choice_url"])
+                if redeem_keys and month["gamekey"] not in try_redeem_keys:
                     # May have redeemed keys on the webpage.
                     try_redeem_keys.append(month["gamekey"])
             else:
@@ -878,20 +2639,44 @@ def humble_chooser_mode(humble_session,order_details):
                         confirmed = prompt_yes_no("Please type 'y' to confirm your selection")
                         if confirmed:
                             choice_month_name = month["product"]["choice_url"]
-                            identifier = month["parent_identifier"]
-                            choose_games(humble_session,choice_month_name,identifier,chosen)
-                            if redeem_keys:
-                                try_redeem_keys.append(month["gamekey"])
+                            for choice in chosen:
+                                if "tpkds" not in choice:
+                                    webbrowser.open(f"{HUMBLE_SUB_PAGE}{choice_month_name}/{choice['display_item_machine_name']}")
+                            chosen = [choice for choice in chosen if "tpkds" in choice]
+                            if chosen:
+                                choosing.append((month["gamekey"], in_background(choose_month,humble_session,month,chosen,redeem_keys)))
+                            forget_month_data(choice_month_name)
                             ready = True
     if(first):
         print("No Humble Choices need choosing! Look at you all up-to-date!")
     else:
         print("No more unchosen Humble Choices")
+        chosen_keys = []
+        for gamekey, future in choosing:
+            made, failed, keys = future.result()
+            for choice in made:
+                print("Chose game " + choice["title"])
+            for choice, res in failed:
+                print("Error choosing " + choice["title"])
+                print(res)
+            if keys is None:
+                if gamekey not in try_redeem_keys:
+                    try_redeem_keys.append(gamekey)
+            else:
+                chosen_keys.extend(keys)
         if(redeem_keys and len(try_redeem_keys) > 0):
+            # Months opened on the webpage may have had anything chosen there
+            updated_monthlies = get_humble_orders(humble_session,try_redeem_keys,refresh=True)
+            handed_off = set((key["gamekey"], key["keyindex"]) for key in chosen_keys)
+            previous_keys = previous_key_values()
+            chosen_keys.extend(
+                key for key in indexed_keys(build_key_index(updated_monthlies),"steam_app_id")
+                if (key["gamekey"], key["keyindex"]) not in handed_off
+                and key.get("redeemed_key_val",False) not in previous_keys
+            )
+        if(redeem_keys and len(chosen_keys) > 0):
             print("Redeeming keys now!")
-            updated_monthlies = humble_session.execute_async_script(getHumbleOrders.replace('%optional%',json.dumps(try_redeem_keys)))
-            chosen_keys = list(find_dict_keys(updated_monthlies,"steam_app_id",True))
-            redeem_steam_keys(humble_session,chosen_keys)
+            redeem_steam_keys(humble_session,chosen_keys,steam_preload)
 
 def cls():
     os.system('cls' if os.name=='nt' else 'clear')
@@ -902,63 +2687,100 @@ def print_main_header():
     print("--------------------------------------")
     
 if __name__=="__main__":
+    app_list_refresh = "--refresh-app-list" in sys.argv
+    order_cache_refresh = "--refresh-orders" in sys.argv
+
+    if "--export-ledger" in sys.argv:
+        export_ledger_csv()
+        sys.exit()
+
+    if "--query-ledger" in sys.argv:
+        since = sys.argv[sys.argv.index("--since") + 1] if "--since" in sys.argv else None
+        print_ledger_query(sys.argv[sys.argv.index("--query-ledger") + 1], since)
+        sys.exit()
+
+    if "--prometheus-textfile" in sys.argv:
+        prometheus_textfile = sys.argv[sys.argv.index("--prometheus-textfile") + 1]
+    process_quit(save_metrics)
+
+    if "--seed-packages" in sys.argv:
+        cache = seed_package_cache(sys.argv[sys.argv.index("--seed-packages") + 1])
+        print(f"{len(cache)} Steam packages cached")
+
+    if "--seed-app-list" in sys.argv:
+        count = seed_app_list_cache(sys.argv[sys.argv.index("--seed-app-list") + 1])
+        print(f"{count} Steam apps cached")
+
+    if "--daemon" in sys.argv:
+        daemon_mode(sys.argv[sys.argv.index("--daemon") + 1])
+        sys.exit()
+
     # Create a consistent session for Humble API use
-    driver = get_headless_driver()
-    humble_login(driver)
+    humble_session = get_humble_session()
     print("Successfully signed in on Humble.")
 
-    print(f"Getting order details, please wait")
+    # Orders and Steam ownership don't depend on each other or on the answers, load them while the user picks
+    orders = in_background(get_humble_keys, humble_session, refresh=order_cache_refresh, progress=False)
+    steam_preload = in_background(preload_steam)
 
-    order_details = driver.execute_async_script(getHumbleOrders.replace('%optional%',''))
+    desired_mode = prompt_mode()
+    if not orders.done():
+        print(f"Getting order details, please wait")
+    order_details, key_index = orders.result()
+    # Keys are in key_index now and only Humble Choice months are needed as orders, so drop
+    # the raw order tree (and the future still holding it) for the rest of the run
+    order_details = choice_months(order_details)
+    orders = None
 
-    desired_mode = prompt_mode(order_details,driver)
     if(desired_mode == "2"):
-        export_mode(driver,order_details)
+        export_mode(humble_session,order_details,key_index,steam_preload)
         sys.exit()
     if(desired_mode == "3"):
-        humble_chooser_mode(driver,order_details)
+        humble_chooser_mode(humble_session,order_details,key_index,steam_preload)
         sys.exit()
 
     # Auto-Redeem mode
     cls()
     unrevealed_keys = []
     revealed_keys = []
-    steam_keys = list(find_dict_keys(order_details,"steam_app_id",True))
+    steam_keys = indexed_keys(key_index,"steam_app_id")
 
-    filters = ["errored.csv", "already_owned.csv", "redeemed.csv"]
+    previous_keys = previous_key_values()
     original_length = len(steam_keys)
-    for filter_file in filters:
-        try:
-            with open(filter_file, "r") as f:
-                keycols = f.read()
-            filtered_keys = [keycol.strip() for keycol in keycols.replace("\n", ",").split(",")]
-            steam_keys = [key for key in steam_keys if key.get("redeemed_key_val",False) not in filtered_keys]
-        except FileNotFoundError:
-            pass
+    steam_keys = [key for key in steam_keys if key.get("redeemed_key_val",False) not in previous_keys]
     if len(steam_keys) != original_length:
         print("Filtered {} keys from previous runs".format(original_length - len(steam_keys)))
 
+    revealed_ahead = load_revealed_ahead(previous_keys)
+    resumed = 0
     for key in steam_keys:
-        if "redeemed_key_val" in key:
+        if "redeemed_key_val" in key and (key["gamekey"], key["keyindex"]) in revealed_ahead:
+            # Revealed by a run that stopped before Steam got to it. It's still pending whichever keys get picked.
+            revealed_keys.append(key)
+            unrevealed_keys.append(key)
+            resumed = resumed + 1
+        elif "redeemed_key_val" in key:
             revealed_keys.append(key)
         else:
             # Has not been revealed via Humble yet
             unrevealed_keys.append(key)
 
     print(
-        f"{len(steam_keys)} Steam keys total -- {len(revealed_keys)} revealed, {len(unrevealed_keys)} unrevealed"
+        f"{len(steam_keys)} Steam keys total -- {len(revealed_keys) - resumed} revealed, {len(unrevealed_keys) - resumed} unrevealed"
     )
+    if resumed:
+        print(f"{resumed} keys revealed last time never made it to Steam, they'll be redeemed too")
 
     will_reveal_keys = prompt_yes_no("Would you like to redeem on Humble as-yet un-revealed Steam keys?"
                                 " (Revealing keys removes your ability to generate gift links for them)")
     if will_reveal_keys:
         try_already_revealed = prompt_yes_no("Would you like to attempt redeeming already-revealed keys as well?")
         # User has chosen to either redeem all keys or just the 'unrevealed' ones.
-        redeem_steam_keys(driver, steam_keys if try_already_revealed else unrevealed_keys)
+        redeem_steam_keys(humble_session, steam_keys if try_already_revealed else unrevealed_keys, steam_preload)
     else:
         # User has excluded unrevealed keys.
-        redeem_steam_keys(driver, revealed_keys)
+        redeem_steam_keys(humble_session, revealed_keys, steam_preload)
 
     # Cleanup
-    for f in files:
-        files[f].close()
+    if ledger is not None:
+        ledger.close()
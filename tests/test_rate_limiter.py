@@ -0,0 +1,49 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import humblesteamkeysredeemer as redeemer
+
+
+class SteamRateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.limiter = redeemer.SteamRateLimiter(
+            os.path.join(self.directory.name, "ratelimit"), success_limit=50, failure_limit=10, window=3600
+        )
+
+    def tearDown(self):
+        self.limiter.db.close()
+        self.directory.cleanup()
+
+    def add(self, at, kind):
+        self.limiter.db.execute("INSERT INTO attempts (at, kind) VALUES (?, ?)", (at, kind))
+
+    def next_attempt(self, now):
+        return self.limiter._next_attempt(self.limiter._attempts(now), now)
+
+    def test_53_frees_up_a_window_after_the_oldest_counted_attempt(self):
+        for at in range(0, 100, 10):
+            self.add(at, "success")
+        self.add(100, "limited")
+        for now in (101, 1800, 3599):
+            self.assertEqual(self.next_attempt(now), 3600)
+        # The oldest success has left the window by now, the release time mustn't move with it
+        for now in (3605, 3650, 3699):
+            self.assertEqual(self.next_attempt(now), now)
+
+    def test_53_with_nothing_counted_waits_a_window(self):
+        self.add(100, "limited")
+        self.assertEqual(self.next_attempt(200), 3700)
+
+    def test_attempt_after_53_lifts_it(self):
+        self.add(0, "success")
+        self.add(100, "limited")
+        self.add(200, "success")
+        self.assertEqual(self.next_attempt(300), 300)
+
+
+if __name__ == "__main__":
+    unittest.main()